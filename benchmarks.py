@@ -0,0 +1,180 @@
+'''Micro-benchmarks for the game's hot paths, each swept over entity counts.
+
+Prints one JSON object per measurement, with the best and mean microseconds per
+call. n is the number of loaded platforms, or of butterflies for butterfly_update
+and butterfly_offscreen, spikes for bomb_explode and of each for handle_collisions,
+or the section name for load_section_into_rows.
+
+Example: python benchmarks.py --only butterfly_update draw --output bench.jsonl
+'''
+import argparse, json, time
+from main import Game
+from classes import Bomb, Spike
+
+SIZES = (100, 400, 1600, 6400)
+SWARM_SIZES = (10, 100, 1000)
+
+def measure(function, calls, repeats=5, setup=None):
+    '''Calls function calls times per batch, over repeats batches.
+    setup, if given, runs untimed before every call.
+    returns (best, mean) seconds per call'''
+    batches = []
+    for _ in range(repeats):
+        spent = 0.0
+        for _ in range(calls):
+            if setup is not None:
+                setup()
+            t0 = time.perf_counter()
+            function()
+            spent += time.perf_counter() - t0
+        batches.append(spent / calls)
+    return min(batches), sum(batches) / len(batches)
+
+def fresh_world(game, platforms, seed=1):
+    '''Resets game and loads sections until at least platforms platforms exist.
+    No spikes or butterflies spawn, so each benchmark adds exactly what it needs'''
+    game.reset(seed)
+    game.luck = -10000 #no butterflies
+    game.maybe_spawn_spike = lambda *spike: None
+    game.alive = True
+    while len(game.platforms) < platforms:
+        game.load_new_section()
+
+def bench_update_position(game, sizes, swarmSizes):
+    for n in sizes:
+        fresh_world(game, n)
+        bomb = Bomb(game, 21, 60, 20, 20, 0, 0)
+        def move():
+            bomb.x = 21
+            bomb.y = 60
+            bomb.update_position([-2, 3], game.tilegrid)
+        yield n, measure(move, 2000)
+
+def bench_load_section_into_rows(game, sizes, swarmSizes):
+    fresh_world(game, 0)
+    for name in ["start"] + game.sectionCache.numbered_sections():
+        def load():
+            game.load_section_into_rows(name)
+            game.rows.clear()
+        yield name, measure(load, 500)
+
+def bench_texture_next_row_of_tiles(game, sizes, swarmSizes):
+    for n in sizes:
+        fresh_world(game, n)
+        def spawn_untextured_section():
+            #Load a section without texturing it, so there are rows left to texture
+            height = game.load_section_into_rows("start")
+            for row in range(len(game.rows) - height, len(game.rows)):
+                game.spawn_row_of_platforms(row)
+        spawn_untextured_section()
+        def setup():
+            if game.terrain.nextToTexture + 1 >= game.terrain.first + len(game.terrain):
+                spawn_untextured_section()
+        yield n, measure(game.texture_next_row_of_tiles, 200, setup=setup)
+
+def bench_texture_tile(game, sizes, swarmSizes):
+    for n in sizes:
+        fresh_world(game, n)
+        row = game.terrain.nextToTexture - 1
+        upper = game.terrain.padded_mask(row-1)
+        same = game.terrain.padded_mask(row)
+        lower = game.terrain.padded_mask(row+1)
+        platforms = game.terrain.row(row)
+        def texture_row():
+            for platform in platforms:
+                game.texture_tile(platform, upper, same, lower)
+        best, mean = measure(texture_row, 500)
+        yield n, (best / len(platforms), mean / len(platforms))
+
+def swarm_update(game, swarmSizes, top, bottom):
+    '''Times the butterfly swarm's update, spawning each butterfly between the world
+    heights top and bottom with the camera at the top of the world'''
+    for n in swarmSizes:
+        fresh_world(game, 400)
+        for _ in range(n):
+            game.butterflies.spawn(game.random.butterflies.randint(0, 200), game.random.butterflies.randint(top, bottom))
+        yield n, measure(game.butterflies.update, 50)
+
+def bench_butterfly_update(game, sizes, swarmSizes):
+    #Mid-screen, where the swarm flies every frame
+    yield from swarm_update(game, swarmSizes, 100, 200)
+
+def bench_butterfly_offscreen(game, sizes, swarmSizes):
+    #Far below the screen, where the swarm mostly skips frames and catches up on them
+    yield from swarm_update(game, swarmSizes, 1000, 1500)
+
+def bench_bomb_explode(game, sizes, swarmSizes):
+    for n in swarmSizes:
+        fresh_world(game, 400)
+        bomb = Bomb(game, 100, 200, 20, 20, 0, 0)
+        def scatter_spikes():
+            for spike in game.spikes:
+                spike.kill()
+                game.spikes.remove(spike)
+            for i in range(n):
+                #Half of them inside the blast
+                if i % 2:
+                    x, y = game.random.spikes.randint(90, 110), game.random.spikes.randint(190, 210)
+                else:
+                    x, y = game.random.spikes.randint(0, 190), game.random.spikes.randint(0, 1500)
+                spike = Spike(game, x, y, "N")
+                game.allSprites.add(spike, layer=-1)
+                game.spikes.add(spike)
+        yield n, measure(bomb.explode, 20, setup=scatter_spikes)
+
+def bench_handle_collisions(game, sizes, swarmSizes):
+    for n in swarmSizes:
+        fresh_world(game, 400)
+        for _ in range(n):
+            game.butterflies.spawn(game.random.butterflies.randint(0, 200), game.random.butterflies.randint(0, 1500))
+            spike = Spike(game, game.random.spikes.randint(0, 190), game.random.spikes.randint(0, 1500), "N")
+            game.allSprites.add(spike, layer=-1)
+            game.spikes.add(spike)
+        for i in range(10): #some will explode on the first call, then it's steady
+            bomb = Bomb(game, 20*i, 100*i, 20, 20, 0, 0)
+            game.allSprites.add(bomb)
+            game.thrownBombs.add(bomb)
+        yield n, measure(game.handle_collisions, 50)
+
+def bench_draw(game, sizes, swarmSizes):
+    for n in sizes:
+        fresh_world(game, n)
+        def forget_last_frame():
+            #Nothing moves between calls, so make every call a full redraw
+            game.lastView = None
+        yield n, measure(game.draw, 50, setup=forget_last_frame)
+
+BENCHMARKS = {
+    'update_position': bench_update_position,
+    'load_section_into_rows': bench_load_section_into_rows,
+    'texture_next_row_of_tiles': bench_texture_next_row_of_tiles,
+    'texture_tile': bench_texture_tile,
+    'butterfly_update': bench_butterfly_update,
+    'butterfly_offscreen': bench_butterfly_offscreen,
+    'bomb_explode': bench_bomb_explode,
+    'handle_collisions': bench_handle_collisions,
+    'draw': bench_draw,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES, help='platform counts to sweep over')
+    parser.add_argument('--swarm-sizes', nargs='+', type=int, default=SWARM_SIZES,
+                        help='butterfly and spike counts to sweep over')
+    parser.add_argument('--output', metavar='FILE', help='also write the results to FILE')
+    args = parser.parse_args()
+
+    game = Game(headless=True)
+    output = open(args.output, 'w') if args.output else None
+    for name in args.only or BENCHMARKS:
+        for size, (best, mean) in BENCHMARKS[name](game, args.sizes, args.swarm_sizes):
+            result = {'benchmark': name, 'n': size, 'best_us': best * 1e6, 'mean_us': mean * 1e6}
+            print(json.dumps(result))
+            if output:
+                output.write(json.dumps(result) + '\n')
+    if output:
+        output.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,83 @@
 import pygame as pg
 from pygame.locals import *
-import math, os, sys
-from random import randint
+import os, sys, json, zlib, time, threading, functools
+from collections import deque
+import random
+import numpy as np
 import constants
 
+class Tracer:
+    '''Records spans of the game's phases as Chrome trace events, which can be opened
+    in chrome://tracing or ui.perfetto.dev. Spans go into an in-memory ring buffer
+    that a background thread formats and writes out, so the main loop never
+    touches the file. If the writer falls behind, the oldest spans are dropped'''
+    def __init__(self, capacity=65536):
+        self.active = False
+        self.buffer = deque(maxlen=capacity)
+        self.recorded = 0
+        self.written = 0
+
+    def start(self, path):
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.separator = ''
+        self.origin = time.perf_counter()
+        self.active = True
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        '''Writes out the remaining spans and closes the file. returns the number of dropped spans'''
+        if not self.active:
+            return 0
+        self.active = False
+        self.writer.join()
+        self.flush()
+        self.file.write('\n]\n')
+        self.file.close()
+        return self.recorded - self.written
+
+    def complete(self, name, start, end):
+        self.buffer.append((name, start, end))
+        self.recorded += 1
+
+    def write_loop(self):
+        while self.active:
+            time.sleep(0.1)
+            self.flush()
+
+    def flush(self):
+        lines = []
+        while self.buffer:
+            name, start, end = self.buffer.popleft()
+            lines.append(json.dumps({'name': name, 'ph': 'X', 'pid': 1, 'tid': 1,
+                                     'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}))
+        if lines:
+            self.file.write(self.separator + ',\n'.join(lines))
+            self.separator = ',\n'
+            self.written += len(lines)
+
+tracer = Tracer()
+
+def traced(name):
+    '''Decorator recording every call of a function as a span while tracer is active'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.active:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer.complete(name, start, time.perf_counter())
+        return wrapper
+    return decorate
+
 class Spritesheet:
-    def __init__(self, filename, bgColor):
-        filename = os.path.join('resources','images','spritesheets',filename)
-        self._spritesheet = pg.image.load(filename).convert()
+    def __init__(self, sheet, bgColor):
+        '''@param sheet: the whole spritesheet, as loaded by Assets'''
+        self._spritesheet = sheet.convert()
         self.backgroundColor = bgColor
 
     def get_image(self, x, y, width, height):
@@ -16,57 +86,336 @@ class Spritesheet:
         image.blit(self._spritesheet, (0, 0), (x, y, width, height))
         return image
 
-class Butterfly(pg.sprite.Sprite):
-    def __init__(self, game, x, y):
-        super().__init__()
-        self.spritesheet = Spritesheet('butterfly.png', constants.WHITE)
-        self.animation = self.load_animation()
-        self.liveframes = 0
-        self.game = game
-        self.image = self.animation[self.liveframes % len(self.animation)]
-        self.hitbox = Rect(x+6, y+6, 4, 4)
-        self.rect = self.image.get_rect()
-        self.rect.x = x
-        self.rect.y = y
-        self.direction = randint(0,359)
-        self.type = "butterfly"
-        self.x = x
-        self.y = y
-        self.speed = 1.5
+class Assets:
+    '''Registry of every image, animation and sound the game uses. preload() reads
+    them all from disk once, after that objects only get shared references.
+    The load counters let us check that nothing is read from disk during play.
+    SectionCache counts its section decodes through them too'''
+    def __init__(self):
+        self.images = {}
+        self.animations = {}
+        self.sheets = {}
+        self.sounds = {}
+        self.loadCounts = {'image': 0, 'sound': 0, 'section': 0}
+        self.bytesLoaded = 0
+
+    def preload(self):
+        for direction in ('N', 'E', 'S', 'W'):
+            self.images['spike_' + direction] = self.load_icon('spike_{}.png'.format(direction))
+        for name in ('bomb_icon', 'pale_bomb_icon', 'bomb_upgrade'):
+            self.images[name] = self.load_icon(name + '.png')
+
+        self.sheets['soil'] = Spritesheet(self.load_image('spritesheets', 'soil-tiles.png'), constants.BLACK)
+        butterflySheet = Spritesheet(self.load_image('spritesheets', 'butterfly.png'), constants.WHITE)
+        self.animations['butterfly'] = Butterfly.load_animation(butterflySheet)
+        self.animations['butterfly_headings'] = self.rotation_atlas(self.animations['butterfly'], constants.BUTTERFLY_HEADINGS)
+        bombSheet = Spritesheet(self.load_image('spritesheets', 'bomb.png'), constants.WHITE)
+        self.animations['bomb'] = Bomb.load_animations(bombSheet)
+        playerSheet = Spritesheet(self.load_image('spritesheets', 'player.png'), constants.PLAYER_BG)
+        self.animations['player'] = Player.load_animations(playerSheet)
+
+        for name in ('boom', 'jump', 'game_over'):
+            self.sounds[name] = self.load_sound(name + '.wav')
 
-    def load_animation(self):
-        f1 = self.spritesheet.get_image(0, 0, 16, 16)
-        f2 = self.spritesheet.get_image(16, 0, 16, 16)
-        f3 = self.spritesheet.get_image(32, 0, 16, 16)
+    def rotation_atlas(self, animation, headings):
+        '''returns, for each frame of animation, a list of that frame rotated to
+        each of the evenly spaced headings (counterclockwise from 0 degrees).
+        Frames that repeat in the animation share their rotations'''
+        rotations = {}
+        atlas = []
+        for frame in animation:
+            if frame not in rotations:
+                rotations[frame] = [pg.transform.rotate(frame, heading * 360 / headings) for heading in range(headings)]
+            atlas.append(rotations[frame])
+        return atlas
+
+    def load_image(self, *pathParts):
+        path = os.path.join('resources', 'images', *pathParts)
+        self.count_load('image', path)
+        return pg.image.load(path)
+
+    def load_icon(self, filename):
+        icon = self.load_image(filename).convert()
+        icon.set_colorkey(constants.WHITE)
+        return icon
+
+    def load_sound(self, filename):
+        path = os.path.join('resources', 'sounds', filename)
+        self.count_load('sound', path)
+        return pg.mixer.Sound(path)
+
+    def count_load(self, kind, path):
+        self.loadCounts[kind] += 1
+        self.bytesLoaded += os.path.getsize(path)
+
+    def stats(self):
+        '''returns a dict with the number of files loaded of each kind and the bytes read'''
+        stats = dict(self.loadCounts)
+        stats['bytes'] = self.bytesLoaded
+        return stats
+
+class SectionCache:
+    '''Decodes each section PNG once into the columns occupied on each row.
+    A file is only decoded again if its modification time changes, so the
+    level editor keeps working while the game is running'''
+    def __init__(self, folder, assets):
+        '''@param assets: the Assets whose load counters count the decodes'''
+        self.folder = folder
+        self.assets = assets
+        self.sections = {} #name -> (mtime, rows)
+        self.folderMtime = None
+        self.numbered = []
+
+    def numbered_sections(self):
+        '''returns the names of all numbered sections, in numerical order'''
+        mtime = os.path.getmtime(self.folder)
+        if mtime != self.folderMtime:
+            self.folderMtime = mtime
+            numbers = []
+            for filename in os.listdir(self.folder):
+                name = filename[len('section_'):-len('.png')]
+                if filename.startswith('section_') and filename.endswith('.png') and name.isdigit():
+                    numbers.append(int(name))
+            self.numbered = [str(number) for number in sorted(numbers)]
+        return self.numbered
+
+    def numbered_rows(self):
+        '''returns the rows of all numbered sections, in numerical order'''
+        return tuple(self.get(name) for name in self.numbered_sections())
+
+    def preload(self):
+        self.get("start")
+        for name in self.numbered_sections():
+            self.get(name)
+
+    def get(self, name):
+        '''returns a tuple with one entry per row, each a tuple of the occupied columns'''
+        sectionPath = os.path.join(self.folder, 'section_{}.png'.format(name))
+        mtime = os.path.getmtime(sectionPath)
+        cached = self.sections.get(name)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, self.decode(sectionPath))
+            self.sections[name] = cached
+        return cached[1]
+
+    def decode(self, sectionPath):
+        self.assets.count_load('section', sectionPath)
+        pixels = pg.surfarray.array3d(pg.image.load(sectionPath))
+        solid = (pixels == 0).all(axis=2) #black pixels, indexed [x, y]
+        return tuple(tuple(solid[:, y].nonzero()[0].tolist()) for y in range(solid.shape[1]))
+
+class Butterfly:
+    '''A handle on one butterfly of a ButterflySwarm, with what collision handlers
+    look at. Handles are made by ButterflySwarm.query and only stay valid until
+    the next butterfly spawns'''
+    __slots__ = ('swarm', 'index')
+    type = "butterfly"
+
+    def __init__(self, swarm, index):
+        self.swarm = swarm
+        self.index = index
+
+    @property
+    def rect(self):
+        size = self.swarm.size
+        return Rect(int(self.swarm.left[self.index]), int(self.swarm.top[self.index]), size, size)
+
+    @property
+    def hitbox(self):
+        return Rect(int(self.swarm.left[self.index])+6, int(self.swarm.top[self.index])+6, 4, 4)
+
+    def alive(self):
+        return bool(self.swarm.live[self.index])
+
+    def kill(self):
+        self.swarm.remove(self.index)
+
+    @staticmethod
+    def load_animation(spritesheet):
+        f1 = spritesheet.get_image(0, 0, 16, 16)
+        f2 = spritesheet.get_image(16, 0, 16, 16)
+        f3 = spritesheet.get_image(32, 0, 16, 16)
         animation = [f1, f1, f1, f2, f2, f2, f3, f3, f3, f3, f3, f2, f2, f2]
         return animation
 
+class ButterflySwarm(pg.sprite.Sprite):
+    '''All the butterflies of a run, kept as NumPy arrays of their positions,
+    headings and ages, and advanced all at once. Like TerrainRows, it draws the
+    butterflies that are in view wherever it sits among the layers of allSprites.
+    The slots of dead butterflies go to the next ones to spawn.
+    While no butterfly is within constants.CULL_MARGIN of the screen, the swarm is
+    only flown every constants.OFFSCREEN_INTERVAL frames, or when something needs it
+    to be up to date, catching up on the frames it skipped in one go.
+    Where the live butterflies are is worked out once after they move, so the
+    per-frame checks and most collision queries don't need any array operations'''
+    size = 16 #width and height of a butterfly's rect
+    speed = 1.5
+    smallSwarm = 16 #up to this many butterflies, queries test them one by one in Python
+
+    def __init__(self, game, capacity=64):
+        super().__init__()
+        self.game = game
+        self.headings = game.assets.animations['butterfly_headings']
+        #The tallest a rotated frame gets, to tell which butterflies are in view
+        self.reach = max(image.get_height() for frame in self.headings for image in frame)
+        self.rng = np.random.default_rng(game.random.steering.getrandbits(64))
+        self.count = 0
+        self.ticks = 0
+        self.flownTo = 0 #the tick the swarm has flown up to
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.direction = np.zeros(capacity, dtype=int) #degrees, counterclockwise from the right
+        self.liveframes = np.zeros(capacity, dtype=int)
+        self.live = np.zeros(capacity, dtype=bool)
+        self.left = np.zeros(capacity, dtype=int) #the rects' corners, in whole pixels
+        self.top = np.zeros(capacity, dtype=int)
+        #How far a butterfly flies in one frame, for each whole degree of direction
+        radians = np.radians(np.arange(360))
+        self.stepX = np.cos(radians) * self.speed
+        self.stepY = np.sin(radians) * -self.speed
+        self.visibleImages = None #(camera, blits) of the last draw, until something moves
+        self.placement = None #see placed(), until something moves
+
+    def __len__(self):
+        return self.count
+
+    def spawn(self, x, y):
+        self.catch_up()
+        free = np.flatnonzero(~self.live)
+        if not len(free):
+            self.grow()
+            free = np.flatnonzero(~self.live)
+        index = free[0]
+        self.x[index] = x
+        self.y[index] = y
+        self.left[index] = x
+        self.top[index] = y
+        self.direction[index] = self.rng.integers(0, 360)
+        self.liveframes[index] = 0
+        self.live[index] = True
+        self.count += 1
+        self.visibleImages = None
+        self.placement = None
+
+    def grow(self):
+        '''Doubles the number of slots'''
+        for name in ('x', 'y', 'direction', 'liveframes', 'live', 'left', 'top'):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+
+    def remove(self, index):
+        '''Kills the butterfly in slot index'''
+        if self.live[index]:
+            self.live[index] = False
+            self.count -= 1
+            self.visibleImages = None
+            self.placement = None
+
     def update(self):
-        self.liveframes += 1
-        self.direction += randint(-30,30)
-        if self.direction < 0:
-            self.direction += 360
-        elif self.direction >= 360:
-            self.direction -= 360
-        rad = math.radians(self.direction)
-        yAdjust = math.sin(rad) * self.speed * -1
-        xAdjust = math.cos(rad) * self.speed
-        self.x += xAdjust
-        self.y += yAdjust
-        
-        if self.x < -16:
-            self.x += 216
-        elif self.x > 200:
-            self.x -= 216
-            
-        self.rect.x = int(self.x)
-        self.rect.y = int(self.y)
-        self.image = self.animation[self.liveframes % len(self.animation)].copy()
-        self.image = pg.transform.rotate(self.image, self.direction)
+        '''Flies the swarm on if any butterfly is near the screen or it is due to catch
+        up, then forgets the butterflies that flew above the screen'''
+        self.ticks += 1
+        if not self.count:
+            self.flownTo = self.ticks #nothing to catch up on
+            return
+        camera = self.game.scrollLength
+        bottom = camera + self.game.truescreen.get_height() + constants.CULL_MARGIN
+        if self.ticks - self.flownTo < constants.OFFSCREEN_INTERVAL and self.placed()[0].top >= bottom:
+            return
+        self.catch_up()
+
+        if self.placed()[0].top + self.size < camera:
+            gone = self.live & (self.top + self.size < camera)
+            self.live &= ~gone
+            self.count -= int(gone.sum())
+            self.placement = None
+
+    def catch_up(self):
+        '''Flies every butterfly on by the frames the swarm is behind, steering once a
+        frame like it would have frame by frame. The moves of those frames are summed
+        before they are added, which can round differently in the last bits and, right
+        at a pixel boundary, put a butterfly one pixel off from where frame by frame
+        flight would. Either way the same run always flies the same'''
+        frames = self.ticks - self.flownTo
+        if not frames:
+            return
+        self.flownTo = self.ticks
+        turns = self.rng.integers(-30, 31, (frames, len(self.live)))
+        if frames == 1:
+            self.direction = (self.direction + turns[0]) % 360
+            self.x += self.stepX[self.direction]
+            self.y += self.stepY[self.direction]
+        else:
+            headings = (self.direction + turns.cumsum(axis=0)) % 360 #after every frame
+            self.direction = headings[-1]
+            self.x += self.stepX[headings].sum(axis=0)
+            self.y += self.stepY[headings].sum(axis=0)
+        self.liveframes += frames
+
+        #Flying off one side of the screen comes back in on the other
+        self.x[self.x < -16] += 216
+        self.x[self.x > 200] -= 216
+
+        self.left = self.x.astype(int)
+        self.top = self.y.astype(int)
+        self.visibleImages = None
+        self.placement = None
+
+    def placed(self):
+        '''returns the Rect around all the live butterflies and, if there are no more
+        than smallSwarm of them, a list of their (slot, left, top), else None.
+        There must be at least one live butterfly'''
+        if self.placement is None:
+            slots = np.flatnonzero(self.live)
+            lefts, tops = self.left[slots], self.top[slots]
+            if len(slots) <= self.smallSwarm:
+                lefts, tops = lefts.tolist(), tops.tolist()
+                few = list(zip(slots.tolist(), lefts, tops))
+                left, right, top, bottom = min(lefts), max(lefts), min(tops), max(tops)
+            else:
+                few = None
+                left, right, top, bottom = int(lefts.min()), int(lefts.max()), int(tops.min()), int(tops.max())
+            bounds = Rect(left, top, right - left + self.size, bottom - top + self.size)
+            self.placement = (bounds, few)
+        return self.placement
+
+    def query(self, rect):
+        '''returns handles on the butterflies whose rect collides with rect'''
+        if not self.count:
+            return []
+        if rect.bottom > self.game.scrollLength + self.game.truescreen.get_height():
+            #Below the screen, butterflies can be behind
+            self.catch_up()
+        bounds, few = self.placed()
+        if not bounds.colliderect(rect):
+            return []
+        if few is not None:
+            size = self.size
+            return [Butterfly(self, index) for index, left, top in few
+                    if left < rect.right and left + size > rect.left and top < rect.bottom and top + size > rect.top]
+        hits = np.flatnonzero(self.live & (self.left < rect.right) & (self.left + self.size > rect.left) &
+                              (self.top < rect.bottom) & (self.top + self.size > rect.top))
+        return [Butterfly(self, index) for index in hits.tolist()]
+
+    def visible_images(self, camera, height):
+        '''returns (image, position) pairs for the butterflies in view of a screen
+        height pixels high, which shows the world from camera pixels down'''
+        if self.visibleImages is None or self.visibleImages[0] != (camera, height):
+            visible = np.flatnonzero(self.live & (self.top < camera + height) & (self.top + self.reach > camera))
+            frames = (self.liveframes[visible] % len(self.headings)).tolist()
+            headings = len(self.headings[0])
+            turns = ((self.direction[visible] * headings / 360 + 0.5).astype(int) % headings).tolist()
+            images = [(self.headings[frame][turn], (x, y - camera)) for frame, turn, x, y in
+                      zip(frames, turns, self.left[visible].tolist(), self.top[visible].tolist())]
+            self.visibleImages = ((camera, height), images)
+        return self.visibleImages[1]
 
-        self.hitbox.x = self.x+6
-        self.hitbox.y = self.y+6
+    def draw(self, surface, camera):
+        surface.blits(self.visible_images(camera, surface.get_height()), False)
 
+    def screen_rects(self, surface, camera):
+        '''returns where on surface the butterflies in view land'''
+        return [Rect(position, image.get_size()) for image, position in self.visible_images(camera, surface.get_height())]
 
 class Background(pg.sprite.Sprite):
     def __init__(self, filename, yPlacement):
@@ -76,40 +425,485 @@ class Background(pg.sprite.Sprite):
         self.rect.left = 0
         self.rect.top = yPlacement
 
-class Platform(pg.sprite.Sprite):
-    def __init__(self, x, y, width, height):
+class RandomStreams:
+    '''Independent random number generators for each subsystem, all derived from
+    one seed, so the same seed and inputs always play out the same run'''
+    names = ('sections', 'butterflies', 'spikes', 'steering', 'drops')
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        for name in self.names:
+            setattr(self, name, random.Random('{}:{}'.format(seed, name)))
+
+class InputTrace:
+    '''The controls of one run, a mask per frame (see Game.apply_controls), and the
+    seed it was played with. Saved as a line of JSON followed by the zlib
+    compressed masks, which is a few bytes per second of play'''
+    version = 1
+
+    def __init__(self, seed, controls=b''):
+        self.seed = seed
+        self.controls = bytearray(controls)
+
+    def __len__(self):
+        return len(self.controls)
+
+    def record(self, controls):
+        self.controls.append(controls)
+
+    def save(self, path):
+        header = {'version': self.version, 'seed': self.seed, 'frames': len(self.controls)}
+        with open(path, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(zlib.compress(bytes(self.controls), 9))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            controls = zlib.decompress(f.read())
+        if header['version'] != cls.version:
+            raise ValueError("Unsupported input trace version {} in {}".format(header['version'], path))
+        return cls(header['seed'], controls)
+
+class ProfilerOverlay:
+    '''Shows a rolling graph of the time spent in events, update and draw each frame,
+    the live entity counts and the worst frame of the last few seconds.
+    Nothing is recorded or drawn while it is hidden'''
+    colors = ((255, 255, 0), (0, 255, 0), (255, 0, 255)) #events, update, draw
+    pixelsPerMs = 5
+
+    def __init__(self, seconds=5, fps=60):
+        self.visible = False
+        self.seconds = seconds
+        self.history = deque(maxlen=seconds*fps)
+        self.graph = pg.Surface((seconds*fps, 100))
+        self.font = pg.font.Font(None, 22)
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.history.clear()
+        self.graph.fill(constants.BLACK)
+
+    def record(self, phaseTimes):
+        '''Adds a frame to the history and scrolls it into the graph'''
+        self.history.append(phaseTimes)
+        width, height = self.graph.get_size()
+        self.graph.scroll(-1, 0)
+        self.graph.fill(constants.BLACK, (width-1, 0, 1, height))
+        bottom = height
+        for seconds, color in zip(phaseTimes, self.colors):
+            top = bottom - seconds * 1000 * self.pixelsPerMs
+            if bottom > 0 and top < bottom - 0.5:
+                pg.draw.line(self.graph, color, (width-1, max(int(top), 0)), (width-1, bottom-1))
+            bottom = max(int(top), 0)
+        budget = height - int(1000 / 60 * self.pixelsPerMs)
+        self.graph.set_at((width-1, budget), constants.RED)
+
+    def draw(self, screen, game, x, y):
+        screen.blit(self.graph, (x, y))
+        lines = []
+        if self.history:
+            latest = self.history[-1]
+            lines.append("events {:.2f}  update {:.2f}  draw {:.2f} ms".format(*[t*1000 for t in latest]))
+            worst = max(sum(frame) for frame in self.history)
+            lines.append("worst frame {:.2f} ms in the last {} s".format(worst*1000, self.seconds))
+        counts = game.entity_counts()
+        lines.append("platforms {}  spikes {}  butterflies {}  bombs {}".format(
+            counts['platforms'], counts['spikes'], counts['butterflies'], counts['bombs']))
+        lines.append("sections loaded {}".format(game.sectionsLoaded))
+        lines.append("pool hits/misses  " + "  ".join("{} {}/{}".format(name, counts['hits'], counts['misses'])
+                                                      for name, counts in game.pool_counts().items()))
+        y += self.graph.get_height() + 4
+        for line in lines:
+            text = self.font.render(line, True, constants.WHITE, constants.BLACK)
+            screen.blit(text, (x, y))
+            y += text.get_height()
+
+class Registry:
+    '''The live entities of one type, in insertion order, with O(1) add and remove.
+    Iteration goes over a snapshot, so entities can be removed mid-loop'''
+    def __init__(self, index=None):
+        '''@param index: a SpatialHash to keep the entities in as well'''
+        self.entities = {}
+        self.index = index
+
+    def add(self, entity):
+        self.entities[entity] = None
+        if self.index is not None:
+            self.index.add(entity)
+
+    def remove(self, entity):
+        '''Does nothing if entity has already been removed'''
+        self.entities.pop(entity, None)
+        if self.index is not None:
+            self.index.remove(entity)
+
+    def __contains__(self, entity):
+        return entity in self.entities
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(list(self.entities))
+
+class SpatialHash:
+    '''Buckets entities in world coordinates, so finding what is near a rect
+    only visits a few cells instead of every entity.
+    Each entity goes into the one cell holding the top left corner of its rect
+    grown by margin on every side, and only moves to another cell once its rect
+    leaves that grown rect, so keeping slow movers up to date is mostly one
+    Rect.contains per entity. Entities may be at most cellSize - 2*margin wide
+    and high, with their hitbox within their rect.
+    Cells are dicts, so queries come out in a deterministic order'''
+    def __init__(self, cellSize, margin):
+        self.cellSize = cellSize
+        self.margin = margin
+        self.cells = {} #(column, row) -> {entity: None}
+        self.bounds = {} #entity -> (grown rect, cell)
+
+    def add(self, entity):
+        grown = entity.rect.inflate(2*self.margin, 2*self.margin)
+        cell = (grown.x // self.cellSize, grown.y // self.cellSize)
+        self.bounds[entity] = (grown, cell)
+        self.cells.setdefault(cell, {})[entity] = None
+
+    def remove(self, entity):
+        '''Does nothing if entity isn't in the hash'''
+        bounds = self.bounds.pop(entity, None)
+        if bounds is None:
+            return
+        cell = self.cells[bounds[1]]
+        del cell[entity]
+        if not cell:
+            del self.cells[bounds[1]]
+
+    def update(self, entities):
+        '''Moves those of entities whose rect left their grown rect to the right cell'''
+        bounds = self.bounds
+        for entity in entities:
+            if not bounds[entity][0].contains(entity.rect):
+                self.remove(entity)
+                self.add(entity)
+
+    def query(self, rect):
+        '''returns the entities that may collide with rect, each once. Whether
+        they actually do is up to the caller to check'''
+        size = self.cellSize
+        cells = self.cells
+        found = {}
+        #A grown rect reaching into rect starts at most one cell up or left of it
+        columns = range((rect.left - size) // size, (rect.right - 1) // size + 1)
+        for row in range((rect.top - size) // size, (rect.bottom - 1) // size + 1):
+            for column in columns:
+                if (column, row) in cells:
+                    found.update(cells[(column, row)])
+        return list(found)
+
+    def __len__(self):
+        return len(self.bounds)
+
+class TileGrid:
+    '''Uniform grid of the loaded platforms, so collision queries only visit
+    the few cells a rect overlaps instead of every platform'''
+    def __init__(self, tileSize):
+        self.tileSize = tileSize
+        self.cells = {}
+
+    def cell_of(self, platform):
+        return (platform.rect.x // self.tileSize, platform.rect.y // self.tileSize)
+
+    def add(self, platform):
+        self.cells[self.cell_of(platform)] = platform
+
+    def remove(self, platform):
+        self.cells.pop(self.cell_of(platform), None)
+
+    def query(self, rect):
+        '''returns the platforms colliding with rect, top row first, left to right'''
+        collisions = []
+        size = self.tileSize
+        for row in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for column in range(rect.left // size, (rect.right - 1) // size + 1):
+                wall = self.cells.get((column, row))
+                if wall is not None and wall.rect.colliderect(rect):
+                    collisions.append(wall)
+        return collisions
+
+class TerrainRows(pg.sprite.Sprite):
+    '''The spawned rows of platforms, indexed by world row number (0 being the
+    top row of the starting section). Each row keeps a bitmask of its
+    occupied columns next to its platforms, so neighbours are bit tests.
+    Once textured, a row's tiles are baked into one strip surface, and the
+    strips are drawn wherever this sprite sits among the layers of allSprites.
+    Other static sprites can be attached to a row to be unloaded with it'''
+    def __init__(self, columns):
         super().__init__()
-        self.image = pg.Surface((width, height))
-        self.image.fill(constants.PURPLE)
+        self.columns = columns
+        self.first = 0 #world row number of the topmost row still loaded
+        self.masks = deque()
+        self.platforms = deque()
+        self.strips = deque()
+        self.attached = deque()
+        self.nextToTexture = 0
+
+    def __len__(self):
+        return len(self.masks)
+
+    def append(self, platforms):
+        mask = 0
+        for platform in platforms:
+            mask |= 1 << (platform.rect.x // constants.TILE_SIZE)
+        self.masks.append(mask)
+        self.platforms.append(platforms)
+        self.strips.append(None)
+        self.attached.append([])
+
+    def attach(self, sprite):
+        '''Attaches a sprite to the row its bottom edge is in, so it is
+        completely off screen once that row is'''
+        row = max((sprite.rect.bottom - 1) // constants.TILE_SIZE, self.first)
+        self.attached[row - self.first].append(sprite)
+
+    def popleft(self):
+        '''Forgets the topmost row, returns its platforms and attached sprites'''
+        self.first += 1
+        self.masks.popleft()
+        self.strips.popleft()
+        return self.platforms.popleft() + self.attached.popleft()
+
+    def top_row_bottom(self):
+        '''returns the world y coordinate of the bottom of the topmost row'''
+        return (self.first + 1) * constants.TILE_SIZE
+
+    def mask(self, row):
+        '''returns the occupancy bitmask of a world row, or None if it isn't loaded'''
+        index = row - self.first
+        if 0 <= index < len(self.masks):
+            return self.masks[index]
+        return None
+
+    def padded_mask(self, row):
+        '''returns the mask of a world row shifted up one bit, with the walls just
+        outside the screen set, so bit c+1 stands for column c.
+        Rows that aren't loaded count as solid'''
+        return self.pad(self.mask(row), self.columns)
+
+    @staticmethod
+    def pad(mask, columns):
+        '''see padded_mask, a mask of None stands for a row that isn't loaded'''
+        if mask is None:
+            return (1 << (columns + 2)) - 1
+        return (mask << 1) | 1 | (1 << (columns + 1))
+
+    @staticmethod
+    def neighbor_key(column, upper, same, lower):
+        '''returns the autotile index of the tile in column, given the padded masks
+        of its row and the rows above and below it.
+        Bits, lowest first: upleft, up, upright, left, right, downleft, down, downright'''
+        return ((upper >> column & 7) | (same >> column & 1) << 3 | (same >> column+2 & 1) << 4 |
+                (lower >> column & 7) << 5)
+
+    def row(self, row):
+        return self.platforms[row - self.first]
+
+    def bake(self, row):
+        '''Draws the textured platforms of a world row into its strip'''
+        strip = pg.Surface((self.columns * constants.TILE_SIZE, constants.TILE_SIZE))
+        strip.set_colorkey(constants.BLACK) #the tiles' own colorkey
+        strip.blits([(platform.image, (platform.rect.x, 0)) for platform in self.row(row)], False)
+        self.strips[row - self.first] = strip
+
+    def draw(self, surface, camera):
+        '''Blits the baked strips of the rows that intersect surface, which shows
+        the world from camera pixels down'''
+        size = constants.TILE_SIZE
+        lastRow = (camera + surface.get_height() - 1) // size
+        for row in range(max(camera // size, self.first), min(lastRow + 1, self.first + len(self.strips))):
+            strip = self.strips[row - self.first]
+            if strip is not None:
+                surface.blit(strip, (0, row * size - camera))
+
+class SectionPlanner:
+    '''Plans the sections that come after the loaded ones on a background thread,
+    keeping `ahead` plans ready. A plan holds everything about a section that
+    doesn't need pygame: which section it is, its rows, the autotile key of every
+    tile it lets be textured and the rolls for the spikes those tiles may grow.
+    The main thread only has to create the sprites. It also reads and decodes the
+    section files, and hands the planner their rows.
+    An error while planning is raised again by take(), on the main thread.
+    The planner is the only user of the sections and spikes streams and always
+    plans exactly `ahead` sections past the last one taken, so runs play out the
+    same whatever the thread timing'''
+    def __init__(self, sections, streams, firstRow, aboveMasks, ahead=2):
+        '''@param sections: the rows of each numbered section, see SectionCache.numbered_rows
+        @param firstRow: the world row the next section starts at
+        @param aboveMasks: the occupancy masks of the two rows above firstRow'''
+        self.sections = sections
+        self.streams = streams
+        self.nextRow = firstRow
+        self.aboveMasks = list(aboveMasks)
+        self.plans = deque()
+        self.wanted = ahead
+        self.planned = 0
+        self.stopping = False
+        self.error = None #what stopped the worker, if it failed
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self.plan_loop, daemon=True)
+        self.worker.start()
+
+    def take(self):
+        '''returns the next plan, a tuple of (first world row, rows, tiles), waiting for it
+        if needed. rows is the section as returned by SectionCache.get(), tiles has one
+        list per row to texture, starting with the row above the section, of
+        (neighbor key, [(x, y, direction, roll) for each spike it may grow]) per tile'''
+        with self.condition:
+            self.wanted += 1
+            self.condition.notify_all()
+            while not self.plans and self.error is None:
+                self.condition.wait()
+            if not self.plans:
+                raise self.error
+            return self.plans.popleft()
+
+    def set_sections(self, sections):
+        '''Plans not started yet pick from sections instead, see __init__'''
+        with self.condition:
+            self.sections = sections
+
+    def stop(self):
+        '''Lets the worker finish the plans it was asked for, then ends it'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.worker.join()
+
+    def plan_loop(self):
+        while True:
+            with self.condition:
+                while self.planned >= self.wanted and not self.stopping:
+                    self.condition.wait()
+                if self.planned >= self.wanted:
+                    return
+                sections = self.sections
+            try:
+                plan = self.plan_section(sections)
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.plans.append(plan)
+                self.planned += 1
+                self.condition.notify_all()
+
+    def plan_section(self, sections):
+        rows = sections[self.streams.sections.randint(1, len(sections)) - 1]
+        masks = self.aboveMasks + [sum(1 << column for column in row) for row in rows]
+        padded = [TerrainRows.pad(mask, constants.COLUMNS) for mask in masks]
+        firstRow = self.nextRow
+
+        #The row above the section gets textured too, now that the row below it is known
+        tiles = []
+        for i in range(1, len(masks) - 1):
+            y = (firstRow - 2 + i) * constants.TILE_SIZE
+            rowTiles = []
+            for column in range(constants.COLUMNS):
+                if not masks[i] >> column & 1:
+                    continue
+                neighborkey = TerrainRows.neighbor_key(column, padded[i-1], padded[i], padded[i+1])
+                spikes = []
+                for direction, bit, dx, dy in Spike.sides:
+                    if not neighborkey >> bit & 1:
+                        spikes.append((column * constants.TILE_SIZE + dx, y + dy, direction,
+                                       self.streams.spikes.randint(1,1000)))
+                rowTiles.append((neighborkey, spikes))
+            tiles.append(rowTiles)
+
+        self.aboveMasks = masks[-2:]
+        self.nextRow += len(rows)
+        return firstRow, rows, tiles
+
+class Pool:
+    '''Instances of an entity class that are done with, kept to be handed out again
+    instead of allocating new ones. A recycled instance is set up again by its
+    setup(), which takes the same arguments as the class.
+    hits counts the instances handed out again, misses those that had to be made'''
+    def __init__(self, entityClass):
+        self.entityClass = entityClass
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.free)
+
+    def acquire(self, *args):
+        if self.free:
+            self.hits += 1
+            entity = self.free.pop()
+            entity.setup(*args)
+            return entity
+        self.misses += 1
+        return self.entityClass(*args)
+
+    def release(self, entity):
+        '''entity must be out of every group and registry already, and not be
+        released again before it is acquired'''
+        self.free.append(entity)
+
+class Platform:
+    '''One tile of terrain. Platforms aren't sprites, TerrainRows draws their rows'''
+    __slots__ = ('image', 'rect', 'has_texture', 'neighborkey')
+    type = "platform"
+    untexturedImages = {} #purple placeholders shared by all untextured platforms, by size
+
+    def __init__(self, x, y, width, height):
+        self.rect = Rect(x, y, width, height)
+        self.setup(x, y, width, height)
+
+    def setup(self, x, y, width, height):
+        if (width, height) not in Platform.untexturedImages:
+            placeholder = pg.Surface((width, height))
+            placeholder.fill(constants.PURPLE)
+            Platform.untexturedImages[(width, height)] = placeholder
+        self.image = Platform.untexturedImages[(width, height)]
         self.has_texture = False
-        self.rect = self.image.get_rect()
-        self.rect.x = x
-        self.rect.y = y
-        self.type = "platform"
+        self.rect.update(x, y, width, height)
 
 class Spike(pg.sprite.Sprite):
+    #For each side of a tile: its direction, the neighbor_key bit that leaves it open,
+    #and where a spike growing on it goes, relative to the tile's top left corner
+    sides = (("N", 1, 2, -11), ("E", 4, 16, 2), ("S", 6, 2, 16), ("W", 3, -11, 2))
+    __slots__ = ('game', 'direction', 'image', 'rect')
+    type = "spike"
+
     def __init__(self, game, x, y, direction):
         super().__init__()
+        self.rect = Rect(0, 0, 0, 0)
+        self.setup(game, x, y, direction)
+
+    def setup(self, game, x, y, direction):
         self.game = game
         self.direction = direction
-        rotation_guide = {"N" : 0, "W" : 90, "S" : 180, "E" : 270}
-        self.image = pg.image.load(os.path.join('resources','images','spike_{}.png'.format(direction))).convert()
-        self.image.set_colorkey(constants.WHITE)
-        self.rect = self.image.get_rect()
-        self.type = "spike"
-        self.x = x
-        self.y = y
-        self.rect.x = x
-        self.rect.y = y
+        self.image = game.assets.images['spike_' + direction]
+        self.rect.update((x, y), self.image.get_size())
 
 class PhysicsObject(pg.sprite.Sprite):
+    __slots__ = ('game',)
+
     def __init__(self, game):
         super().__init__()
         self.game = game
 
+    @traced('update_position')
     def update_position(self, posAdjustment, walls):
         '''Moves the object (updates rect) within the confines of the walls, returns dict collision_directions
-        @param walls: a sprite.Group containing all platforms currently loaded'''
+        @param walls: the TileGrid holding all platforms currently loaded'''
 
         #Assume no collisions
         collision_directions  = {'top':False, 'bottom':False,
@@ -158,25 +952,26 @@ class PhysicsObject(pg.sprite.Sprite):
         return collision_directions
 
     def list_collisions(self, walls):
-        collisions = []
-        for wall in walls:
-            if wall.rect.colliderect(self.hitbox):
-                collisions.append(wall)
-        return collisions
+        return walls.query(self.hitbox)
 
 class Bomb(PhysicsObject):
+    __slots__ = ('animations', 'image', 'currentAnimation', 'rect', 'hitbox', 'x', 'y',
+                 'lifespan', 'hspeed', 'vspeed', 'sound_boom')
+    type = "bomb"
+
     def __init__(self, game, x, y, width, height, hspeed, vspeed):
         super().__init__(game)
+        self.rect = Rect(0, 0, 0, 0)
+        self.hitbox = Rect(0, 0, 0, 0)
+        self.setup(game, x, y, width, height, hspeed, vspeed)
+
+    def setup(self, game, x, y, width, height, hspeed, vspeed):
         self.game = game
-        self.spritesheet = Spritesheet("bomb.png", constants.WHITE)
-        self.animations = self.load_animations()
+        self.animations = game.assets.animations['bomb']
         self.image = self.animations['preboom'][0]
         self.currentAnimation = "preboom"
-        self.rect = self.image.get_rect()
-        self.rect.x = x-4
-        self.rect.y = y-2
-        self.hitbox = Rect(x, y, self.rect.width-8, self.rect.height-4)
-        self.type = "bomb"
+        self.rect.update((x-4, y-2), self.image.get_size())
+        self.hitbox.update(x, y, self.rect.width-8, self.rect.height-4)
         self.x = x
         self.y = y
         self.lifespan = 2*(len(self.animations['preboom'])+len(self.animations['postboom']))
@@ -186,7 +981,7 @@ class Bomb(PhysicsObject):
             self.vspeed = 0
         if not self.game.down_pressed:
             self.vspeed -= 4
-        self.sound_boom = pg.mixer.Sound(os.path.join('resources', 'sounds', 'boom.wav'))
+        self.sound_boom = game.assets.sounds['boom']
 
     def update(self):
         if self.lifespan > 2*len(self.animations["postboom"]):
@@ -195,14 +990,16 @@ class Bomb(PhysicsObject):
             self.vspeed = 15
         self.hspeed *= 0.97
 
-        collision_directions = self.update_position([self.hspeed, self.vspeed], self.game.platforms)
+        collision_directions = self.update_position([self.hspeed, self.vspeed], self.game.tilegrid)
         if collision_directions['bottom']:
             self.vspeed = 0
         elif collision_directions['right'] or collision_directions['left']:
             self.hspeed = 0
 
-        if self.lifespan == 0:
+        if self.lifespan == 0 or self.rect.bottom < self.game.scrollLength:
+            self.game.thrownBombs.remove(self)
             self.kill()
+            self.game.pools['bombs'].release(self)
         if self.lifespan > 2*len(self.animations["postboom"]): #if lifespan > 30
             self.image = self.animations["preboom"][len(self.animations["preboom"])-(self.lifespan - 2*len(self.animations['postboom']))//2-1]
         elif self.lifespan == 2*len(self.animations["postboom"]):
@@ -211,50 +1008,54 @@ class Bomb(PhysicsObject):
             self.image = self.animations["postboom"][len(self.animations["postboom"])-self.lifespan//2-1]
         self.lifespan -= 1
 
-        for spike in self.game.spikes:
-            if spike.rect.colliderect(self.rect):
-                self.explode()
-                self.lifespan = 2*len(self.animations["postboom"])
-        for butt in self.game.butterflies:
-            if butt.rect.colliderect(self.rect) and self.lifespan > 2*len(self.animations["postboom"]):
-                self.explode()
-                self.lifespan = 2*len(self.animations["postboom"])
+    #Collision handlers, called by Game.handle_collisions with whatever the bomb is near
+    def spike_collision(self, spike):
+        if spike.rect.colliderect(self.rect):
+            self.explode()
+            self.lifespan = 2*len(self.animations["postboom"])
 
+    def butterfly_collision(self, butt):
+        if butt.rect.colliderect(self.rect) and self.lifespan > 2*len(self.animations["postboom"]):
+            self.explode()
+            self.lifespan = 2*len(self.animations["postboom"])
+
+    collisionHandlers = {'spike': spike_collision, 'butterfly': butterfly_collision}
+
+    @traced('Bomb.explode')
     def explode(self):
 
         self.hspeed = 0
         self.vspeed = 0
 
         explosionZone = Rect(self.rect.left-5, self.rect.top-5, self.rect.width+10, self.rect.width+10)
-        for spike in self.game.spikes:
-            if spike.rect.colliderect(explosionZone):
-                spike.kill()
-                self.game.spikes.remove(spike)
-        for butt in self.game.butterflies:
-            if butt.rect.colliderect(explosionZone):
-                if randint(1,3) == 3:
-                    self.game.allSprites.add(BombUpgrade(self.game, butt.rect.x, butt.rect.y))
-                butt.kill()
-                self.game.butterflies.remove(butt)
+        for entity in self.game.entities.query(explosionZone):
+            if entity.type == "spike" and entity.rect.colliderect(explosionZone):
+                entity.kill()
+                self.game.spikes.remove(entity)
+        for butt in self.game.butterflies.query(explosionZone):
+            if self.game.random.drops.randint(1,3) == 3:
+                self.game.allSprites.add(BombUpgrade(self.game, butt.rect.x, butt.rect.y))
+            butt.kill()
 
         self.sound_boom.play()
         
-    def load_animations(self):
+    @staticmethod
+    def load_animations(spritesheet):
         '''returns a dictionary of lists, each list an animation cycle'''
         animations = {}
-        pb1 = self.spritesheet.get_image(0, 0, 20, 20)
-        pb2 = self.spritesheet.get_image(20, 0, 20, 20)
-        pb3 = self.spritesheet.get_image(0, 20, 20, 20)
-        pb4 = self.spritesheet.get_image(20, 20, 20, 20)
-        pb5 = self.spritesheet.get_image(0, 40, 20, 20)
-        pb6 = self.spritesheet.get_image(20, 40, 20, 20)
+        pb1 = spritesheet.get_image(0, 0, 20, 20)
+        pb2 = spritesheet.get_image(20, 0, 20, 20)
+        pb3 = spritesheet.get_image(0, 20, 20, 20)
+        pb4 = spritesheet.get_image(20, 20, 20, 20)
+        pb5 = spritesheet.get_image(0, 40, 20, 20)
+        pb6 = spritesheet.get_image(20, 40, 20, 20)
         animations['preboom'] = [pb1]*4 + [pb2]*4 + [pb3]*4 + [pb4]*4 + [pb5]*4 + [pb6]*4
-        pob1 = self.spritesheet.get_image(60, 40, 20, 20)
-        pob2 = self.spritesheet.get_image(40, 40, 20, 20)
-        pob3 = self.spritesheet.get_image(60, 20, 20, 20)
-        pob4 = self.spritesheet.get_image(40, 20, 20, 20)
-        pob5 = self.spritesheet.get_image(60, 0, 20, 20)
-        pob6 = self.spritesheet.get_image(40, 0, 20, 20)
+        pob1 = spritesheet.get_image(60, 40, 20, 20)
+        pob2 = spritesheet.get_image(40, 40, 20, 20)
+        pob3 = spritesheet.get_image(60, 20, 20, 20)
+        pob4 = spritesheet.get_image(40, 20, 20, 20)
+        pob5 = spritesheet.get_image(60, 0, 20, 20)
+        pob6 = spritesheet.get_image(40, 0, 20, 20)
         animations['postboom'] = [pob2, pob2, pob1, pob1, pob1, pob2, pob2,
                                   pob3, pob3, pob4, pob4, pob5, pob5, pob6, pob6]
         return animations
@@ -263,10 +1064,9 @@ class Bomb(PhysicsObject):
 class Player(PhysicsObject):
     def __init__(self, game, x, y, width, height):
         super().__init__(game)
-        self.spritesheet = Spritesheet("player.png", constants.PLAYER_BG)
-        self.animations = self.load_animations()
         self.game = game
-        self.image = self.spritesheet.get_image(16, 478, 16, 24)
+        self.animations = game.assets.animations['player']
+        self.image = self.animations['standing'][0]
         self.hitbox = Rect(x, y, 8, 19)
         self.currentAnimation = 'standing'
         self.rect = self.image.get_rect()
@@ -281,11 +1081,15 @@ class Player(PhysicsObject):
         self.hspeed = 0
         self.debugTick = 0
         self.canDropBomb = True
-        self.sound_jump = pg.mixer.Sound(os.path.join('resources','sounds','jump.wav'))
+        self.sound_jump = game.assets.sounds['jump']
 
     def update(self):
         '''Update the player's position and animation'''
 
+        #Horizontal speed only lasts a frame. It is reset here rather than at the end,
+        #so the collision handlers still see it
+        self.hspeed = 0
+
         #Gravity, speed caps
         if not self.grounded:
             self.vspeed += constants.GRAVITY
@@ -311,14 +1115,15 @@ class Player(PhysicsObject):
                 self.vspeed -= 0.2
         if self.game.space_pressed and self.canDropBomb:
             if self.game.bombs > 0:
-                bomb = Bomb(self.game, self.rect.x, self.rect.y, 20, 20, self.hspeed, self.vspeed)
+                bomb = self.game.pools['bombs'].acquire(self.game, self.rect.x, self.rect.y, 20, 20, self.hspeed, self.vspeed)
                 self.game.allSprites.add(bomb)
+                self.game.thrownBombs.add(bomb)
                 self.game.bombs -= 1
             self.canDropBomb = False
         if not self.game.space_pressed:
             self.canDropBomb = True
 
-        collision_directions = self.update_position([self.hspeed, self.vspeed], self.game.platforms)
+        collision_directions = self.update_position([self.hspeed, self.vspeed], self.game.tilegrid)
         if collision_directions['bottom']:
             self.grounded = True
             self.vspeed = 0
@@ -326,29 +1131,14 @@ class Player(PhysicsObject):
             if not self.thereIsGroundBeneathMe():
                 self.grounded = False
 
-        #Screen scrolling, object unloading
-        if self.hitbox.y > constants.SCROLL_HEIGHT:
-            scrollBonus = self.hitbox.y - constants.SCROLL_HEIGHT
-            self.game.scrollLength += scrollBonus
+        #Screen scrolling (moving the camera down), object unloading
+        if self.hitbox.y - self.game.scrollLength > constants.SCROLL_HEIGHT:
+            self.game.scrollLength = self.hitbox.y - constants.SCROLL_HEIGHT
             for _ in range(int(self.game.scrollLength) // 20 - self.game.rows_killed):
-                self.game.rows.pop(0)
+                self.game.rows.popleft()
                 self.game.rows_killed += 1
-            for sprite in self.game.allSprites:
-                if sprite != self:
-                    sprite.rect.y -= scrollBonus
-                if sprite.type in ("butterfly", "bomb"):
-                    sprite.y -= scrollBonus
-                if sprite.rect.bottom < 0:
-                    if sprite.type == "spike":
-                       self.game.spikes.remove(sprite)
-                    elif sprite.type == "platform":
-                        self.game.platforms.remove(sprite)
-                    elif sprite.type == "butterfly":
-                        self.game.butterflies.remove(sprite)
-                    elif sprite.type == "bomb upgrade":
-                        self.game.bomb_upgrades.remove(sprite)
-                    sprite.kill()
-            self.hitbox.y -= scrollBonus
+            self.game.unload_rows_above_screen()
+            #The camera follows whole pixels, so drop our subpixel position
             self.y = self.hitbox.y
             self.rect.y = int(self.y-2)
 
@@ -365,44 +1155,34 @@ class Player(PhysicsObject):
         elif not self.game.right_pressed and self.currentAnimation in ('jumping', 'falling'):
             self.image = self.animations['jumpingstraight'][0]
 
-        #Check if we've collided with a spike
-        self.spike_collision()
+    #Collision handlers, called by Game.handle_collisions with whatever the player is near
+    def bomb_upgrade_collision(self, bu):
+        if bu.hitbox.colliderect(self.hitbox):
+            if self.game.maxbombs < 11:
+                self.game.maxbombs += 1
+            bu.kill()
+            self.game.bomb_upgrades.remove(bu)
 
-        #Check if we've collided with a butterfly
-        self.butterfly_collision()
+    def butterfly_collision(self, butt):
+        if butt.hitbox.colliderect(self.hitbox):
+            self.die()
 
-        #Check if we've collided with a bomb upgrade
-        self.bomb_upgrade_collision()
-        
-        #Reset hspeed
-        self.hspeed = 0
-
-    def bomb_upgrade_collision(self):
-        for bu in self.game.bomb_upgrades:
-            if bu.hitbox.colliderect(self.hitbox):
-                if self.game.maxbombs < 11:
-                    self.game.maxbombs += 1
-                bu.kill()
-                self.game.bomb_upgrades.remove(bu)
-    def butterfly_collision(self):
-        for butt in self.game.butterflies:
-            if butt.hitbox.colliderect(self.hitbox):
+    def spike_collision(self, spike):
+        if spike.rect.colliderect(self.hitbox):
+            triggered = False
+            if spike.direction == "N" and self.vspeed > 0:
+                triggered = True
+            if spike.direction == "W" and self.hspeed > 0:
+                triggered = True
+            if spike.direction == "S" and self.vspeed < 0:
+                triggered = True
+            if spike.direction == "E" and self.hspeed < 0:
+                triggered = True
+            if triggered:
                 self.die()
 
-    def spike_collision(self):
-        for spike in self.game.spikes:
-            if spike.rect.colliderect(self.hitbox):
-                triggered = False
-                if spike.direction == "N" and self.vspeed > 0:
-                    triggered = True
-                if spike.direction == "W" and self.hspeed > 0:
-                    triggered = True
-                if spike.direction == "S" and self.vspeed < 0:
-                    triggered = True
-                if spike.direction == "E" and self.hspeed < 0:
-                    triggered = True
-                if triggered:
-                    self.die()
+    collisionHandlers = {'spike': spike_collision, 'butterfly': butterfly_collision,
+                         'bomb upgrade': bomb_upgrade_collision}
 
     def die(self):
         self.game.alive = False
@@ -410,40 +1190,40 @@ class Player(PhysicsObject):
         self.kill()
         pg.mixer.music.stop()
 
-    def load_animations(self):
+    @staticmethod
+    def load_animations(spritesheet):
         '''returns a dictionary of lists, each list an animation cycle'''
         animations = {}
-        animations['standing'] = [self.spritesheet.get_image(16, 478, 16, 24)]
-        w1 = self.spritesheet.get_image(86, 439, 16, 24)
-        w2 = self.spritesheet.get_image(104, 439, 16, 24)
-        w3 = self.spritesheet.get_image(122, 439, 16, 24)
+        animations['standing'] = [spritesheet.get_image(16, 478, 16, 24)]
+        w1 = spritesheet.get_image(86, 439, 16, 24)
+        w2 = spritesheet.get_image(104, 439, 16, 24)
+        w3 = spritesheet.get_image(122, 439, 16, 24)
         animations['walking'] = [w2, w2, w2, w3, w3, w3, w3, w2, w2, w2, w1, w1, w1, w1]
-        jUp = self.spritesheet.get_image(308, 439, 16, 24)
-        jDown = self.spritesheet.get_image(332, 439, 16, 24)
-        jStraight = self.spritesheet.get_image(290, 465, 16, 24)
+        jUp = spritesheet.get_image(308, 439, 16, 24)
+        jDown = spritesheet.get_image(332, 439, 16, 24)
+        jStraight = spritesheet.get_image(290, 465, 16, 24)
         animations['jumping'] = [jUp]
         animations['jumpingstraight'] = [jStraight]
         animations['falling'] = [jDown]
-        i1 = self.spritesheet.get_image(86, 465, 16, 24)
+        i1 = spritesheet.get_image(86, 465, 16, 24)
         animations['idle1'] = [i1, i1, i1, i1, i1, i1, i1, i1, i1, i1, i1]
+        animations['dead'] = [spritesheet.get_image(152, 491, 16, 24)]
         return animations    
 
     def spawnDeadFox(self):
-        dead_img = self.spritesheet.get_image(152, 491, 16, 24)
+        dead_img = self.animations['dead'][0]
         deadFox = DeadFox(self.game, self.rect.x, self.rect.y, dead_img)
         self.game.allSprites.add(deadFox)
         self.game.deadFox = deadFox
 
     def thereIsGroundBeneathMe(self):
         slightlyLower = pg.Rect(self.hitbox.left, self.hitbox.top+1, self.hitbox.width, self.hitbox.height)
-        for wall in self.game.platforms:
-            if wall.rect.colliderect(slightlyLower):
-                return True
-        return False
+        return len(self.game.tilegrid.query(slightlyLower)) > 0
 
 class DeadFox(pg.sprite.Sprite):
     def __init__(self, game, x, y, dead_img):
         super().__init__()
+        self.game = game
         self.image = dead_img
         self.rect = self.image.get_rect()
         self.x = x
@@ -457,32 +1237,37 @@ class DeadFox(pg.sprite.Sprite):
         self.y += self.vspeed
         self.rect.y = self.y
 
-        if self.rect.top > 300:
+        if self.rect.top - self.game.scrollLength > 300:
             self.kill()
 
 class BombUpgrade(PhysicsObject):
+    __slots__ = ('image', 'rect', 'hitbox', 'x', 'y', 'vspeed', 'hspeed')
+    type = 'bomb upgrade'
+
     def __init__(self, game, x, y):
         super().__init__(game)
-        self.game = game
         self.image = self.game.guibook['bomb_upgrade']
         self.rect = self.image.get_rect()
         self.hitbox = Rect(x, y, self.rect.width-8, self.rect.height-4)
-        self.type = 'bomb upgrade'
         self.x = x
         self.y = y
         self.rect.x = x
         self.rect.y = y
         self.vspeed = -3
-        self.hspeed = randint(-2,2)
-        self.game.bomb_upgrades.append(self)
+        self.hspeed = self.game.random.drops.randint(-2,2)
+        self.game.bomb_upgrades.add(self)
 
     def update(self):
         self.vspeed += constants.GRAVITY
         self.hspeed *= 0.97
 
-        collision_directions = self.update_position([self.hspeed, self.vspeed], self.game.platforms)
+        collision_directions = self.update_position([self.hspeed, self.vspeed], self.game.tilegrid)
         if collision_directions['bottom']:
             self.vspeed = 0
         elif collision_directions['right'] or collision_directions['left']:
             self.hspeed = 0
+
+        if self.rect.bottom < self.game.scrollLength:
+            self.game.bomb_upgrades.remove(self)
+            self.kill()
         
@@ -7,6 +7,32 @@ WINDOW_WIDTH = 600
 WINDOW_HEIGHT = 900
 SCROLL_HEIGHT = 120
 
+#How truescreen is upscaled to the window: 'fast' for crisp pixels, 'smooth' for filtered
+SCALING = 'fast'
+
+#How frames reach the window: 'dirty' only redraws the regions that changed while the
+#camera stands still (with 'fast' scaling), 'full' redraws everything every frame
+RENDERING = 'dirty'
+
+TILE_SIZE = 20
+COLUMNS = 10
+
+#Number of precomputed butterfly rotations. More looks smoother but uses more memory
+BUTTERFLY_HEADINGS = 64
+
+#Pixels around the truescreen within which sprites are still drawn. While no butterfly is
+#that close, the swarm only flies every OFFSCREEN_INTERVAL frames, which must leave the
+#butterflies less than CULL_MARGIN pixels behind
+CULL_MARGIN = 32
+OFFSCREEN_INTERVAL = 8
+
+#Control bits, as used by Game.apply_controls and recorded inputs
+CONTROL_RIGHT = 1
+CONTROL_LEFT = 2
+CONTROL_UP = 4
+CONTROL_DOWN = 8
+CONTROL_SPACE = 16
+
 PURPLE = (148, 0, 211)
 LIGHT_BLUE = (80,80,255)
 BLACK = (0, 0, 0)
@@ -0,0 +1,65 @@
+'''Runs Catfall without a window, sound or frame cap, for load testing and balance checks.
+
+Example: python headless.py --frames 20000 --runs 5 --seed 1
+Recorded runs (see main.py --record) can be fast-forwarded with --replay.
+'''
+import argparse, atexit, json, random
+import constants
+from main import Game
+from classes import InputTrace, tracer
+
+def wandering_inputs(rng):
+    '''Endless control masks for a player who walks left and right,
+    jumping and dropping bombs now and then'''
+    controls = 0
+    frame = 0
+    while True:
+        if frame % 45 == 0:
+            direction = rng.random()
+            controls &= ~(constants.CONTROL_RIGHT | constants.CONTROL_LEFT)
+            if direction < 0.45:
+                controls |= constants.CONTROL_RIGHT
+            elif direction > 0.55:
+                controls |= constants.CONTROL_LEFT
+        if frame % 7 == 0:
+            controls &= ~(constants.CONTROL_UP | constants.CONTROL_SPACE)
+            if rng.random() < 0.25:
+                controls |= constants.CONTROL_UP
+            if rng.random() < 0.15:
+                controls |= constants.CONTROL_SPACE
+        yield controls
+        frame += 1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, help='maximum frames per run (10000 for scripted runs)')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--seed', type=int, help='seed of the first run, the next runs count up from it')
+    parser.add_argument('--record', metavar='FOLDER', help='save the inputs of every scripted run into FOLDER')
+    parser.add_argument('--replay', nargs='+', metavar='TRACE', help='replay recorded runs instead')
+    parser.add_argument('--chrome-trace', metavar='FILE', help="write a Chrome trace of the game's phases to FILE")
+    args = parser.parse_args()
+
+    if args.chrome_trace:
+        tracer.start(args.chrome_trace)
+        atexit.register(tracer.stop)
+
+    game = Game(headless=True)
+    if args.replay:
+        for path in args.replay:
+            trace = InputTrace.load(path)
+            stats = game.simulate(trace.controls, args.frames, trace.seed)
+            print(json.dumps(stats))
+        return
+
+    for run in range(args.runs):
+        seed = None if args.seed is None else args.seed + run
+        inputs = wandering_inputs(random.Random(seed))
+        stats = game.simulate(inputs, args.frames or 10000, seed)
+        print(json.dumps(stats))
+        if args.record:
+            game.recordFolder = args.record
+            game.save_recording()
+
+if __name__ == '__main__':
+    main()
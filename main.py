@@ -3,37 +3,77 @@ import pygame as pg
 from pygame.locals import *
 import constants
 from classes import *
-import sys, os, time
-from random import randint
+import sys, os, time, argparse, atexit
+from collections import deque
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False):
+        '''@param headless: use SDL's dummy video and audio drivers, for simulate()'''
+        self.headless = headless
+        if headless:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
         pg.mixer.pre_init(44100, -16, 2, 2048)
         pg.init()
         self.clock = pg.time.Clock()
         self.screen = pg.display.set_mode((constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT))
         self.truescreen = pg.Surface((200, 300))
+        self.pixelSize = constants.WINDOW_WIDTH // self.truescreen.get_width() #window pixels per truescreen pixel
         pg.display.set_caption("Catfall")
+        self.assets = Assets()
+        self.assets.preload()
         self.tilebook = self.initialize_tilebook()
+        self.autotiles = self.initialize_autotiles()
+        self.sectionCache = SectionCache(os.path.join('resources', 'images', 'sections'), self.assets)
+        self.sectionCache.preload()
         self.allSprites = pg.sprite.LayeredUpdates()
         self.guibook = self.load_icons()
         self.font = pg.font.Font(pg.font.match_font('arial bold'), 40)
+        self.scoreShown = None #the score scoreSurface was rendered for
         self.deadFox = None
-        self.sound_gameover = pg.mixer.Sound(os.path.join('resources', 'sounds', 'game_over.wav'))
+        self.planner = None #plans the upcoming sections, see load_new_section
+        self.terrain = None #the run's loaded rows, see reset
+        #Entities that come and go all the time are recycled, across runs too
+        self.pools = {'platforms': Pool(Platform), 'spikes': Pool(Spike), 'bombs': Pool(Bomb)}
+        self.recordFolder = None #if set, every run's inputs are saved there
+        self.overlay = ProfilerOverlay()
+        self.sound_gameover = self.assets.sounds['game_over']
 
-    def start(self):
+    def start(self, seed=None, replay=None, fastForwardTo=0):
+        '''See reset() and run() for the parameters'''
 
         pg.mixer.music.load(os.path.join('resources','sounds','Chibi Ninja (Eric Skiff).wav'))
         pg.mixer.music.play(-1)
-        
+        self.reset(seed)
+        self.run(replay, fastForwardTo)
+        self.gameover()
+
+    def reset(self, seed=None):
+        '''Sets up a fresh run, from the starting section.
+        @param seed: seed for self.random, a new random one if None'''
+        self.allSprites.empty()
+        if self.terrain is not None:
+            #Hand the last run's entities back to the pools
+            while len(self.terrain):
+                self.unload_top_row()
+            for bomb in self.thrownBombs:
+                self.pools['bombs'].release(bomb)
+        self.random = RandomStreams(seed)
+        self.inputTrace = InputTrace(self.random.seed)
         self.luck = 0
-        self.butterflies = []
-        self.spikes = []
-        self.bomb_upgrades = []
-        self.rows = []
+        self.entities = SpatialHash(64, 16) #what the player and bombs can run into
+        self.butterflies = ButterflySwarm(self)
+        self.allSprites.add(self.butterflies, layer=2)
+        self.spikes = Registry(self.entities)
+        self.bomb_upgrades = Registry(self.entities)
+        self.thrownBombs = Registry()
+        self.rows = deque()
         self.scrollLength = 0
         self.rows_killed = 0
+        self.sectionsLoaded = 0
         self.ticks_passed = 0
+        self.phaseTimes = (0.0, 0.0, 0.0) #seconds spent in events, update and draw last frame
+        self.lastView = None #what the last drawn frame looked at, see draw()
         self.maxbombs = 3
         self.bombs = 3
         self.score = 0
@@ -44,7 +84,10 @@ class Game:
         self.up_pressed = False
         self.down_pressed = False
         self.space_pressed = False
-        self.platforms = []
+        self.platforms = Registry()
+        self.tilegrid = TileGrid(constants.TILE_SIZE)
+        self.terrain = TerrainRows(constants.COLUMNS)
+        self.allSprites.add(self.terrain, layer=0) #drawn above the player and spikes
 
         self.player = Player(self, constants.WINDOW_WIDTH//12, constants.WINDOW_HEIGHT//12, 16, 24)
         self.allSprites.add(self.player, layer=-2)
@@ -54,18 +97,43 @@ class Game:
             self.spawn_row_of_platforms(rowNumber)
         for _ in range(len(self.rows)-1):
             self.texture_next_row_of_tiles()
-        
-        self.run()
+        self.start_planner()
 
-    def run(self):
+    def run(self, replay=None, fastForwardTo=0):
+        '''@param replay: an iterator of control masks, e.g. from an InputTrace, that
+        drives the game instead of the keyboard until it runs out
+        @param fastForwardTo: frames before this one are played uncapped and not drawn'''
         self.alive = True
         while self.alive:
-            self.clock.tick(60)
-            self.ticks_passed += 1
-            self.events()
-            self.update()
+            fastForward = self.ticks_passed < fastForwardTo
+            if not fastForward:
+                self.clock.tick(60)
+            controls = None
+            if replay is not None:
+                controls = next(replay, None)
+                if controls is None:
+                    replay = None #back to the keyboard
+                    controls = 0
+            self.frame(controls, not fastForward)
+
+    def frame(self, controls=None, draw=True):
+        '''Plays one frame, timing its phases into self.phaseTimes
+        @param controls: a control mask overriding the keyboard, see apply_controls'''
+        t0 = time.perf_counter()
+        self.ticks_passed += 1
+        self.events()
+        if controls is not None:
+            self.apply_controls(controls)
+        self.inputTrace.record(self.controls_mask())
+        t1 = time.perf_counter()
+        self.update()
+        t2 = time.perf_counter()
+        if draw:
             self.draw()
-        self.gameover()
+        t3 = time.perf_counter()
+        self.phaseTimes = (t1 - t0, t2 - t1, t3 - t2)
+        if self.overlay.visible:
+            self.overlay.record(self.phaseTimes)
 
     def events(self):
         for event in pg.event.get():
@@ -83,6 +151,8 @@ class Game:
                     self.down_pressed = True
                 if event.key == K_SPACE:
                     self.space_pressed = True
+                if event.key == K_F3:
+                    self.overlay.toggle()
             elif event.type == KEYUP:
                 if event.key == K_RIGHT:
                     self.right_pressed = False
@@ -95,8 +165,59 @@ class Game:
                 if event.key == K_SPACE:
                     self.space_pressed = False
 
+    def simulate(self, inputs, maxFrames=None, seed=None):
+        '''Plays a fresh run without drawing and without a frame cap, as fast as possible.
+        @param inputs: an iterable of control masks (see apply_controls), one per frame
+        @param seed: see reset()
+        Stops when the player dies, inputs run out or maxFrames frames have passed.
+        returns a dict of statistics about the run'''
+        self.reset(seed)
+        self.alive = True
+        frames = 0
+        t0 = time.perf_counter()
+        for controls in inputs:
+            if maxFrames is not None and frames >= maxFrames:
+                break
+            self.ticks_passed += 1
+            self.apply_controls(controls)
+            self.inputTrace.record(controls)
+            self.update()
+            frames += 1
+            if not self.alive:
+                break
+        seconds = time.perf_counter() - t0
+
+        stats = {'seed': self.random.seed, 'score': self.score, 'frames': frames, 'alive': self.alive,
+                 'seconds': seconds, 'fps': frames / seconds if seconds else 0.0,
+                 'sections loaded': self.sectionsLoaded}
+        stats.update(self.entity_counts())
+        stats['pools'] = self.pool_counts()
+        stats['assets'] = self.assets.stats() #files read from disk since the game started
+        return stats
+
+    def apply_controls(self, controls):
+        '''Sets the *_pressed flags from a mask of constants.CONTROL_* bits'''
+        self.right_pressed = bool(controls & constants.CONTROL_RIGHT)
+        self.left_pressed = bool(controls & constants.CONTROL_LEFT)
+        self.up_pressed = bool(controls & constants.CONTROL_UP)
+        self.down_pressed = bool(controls & constants.CONTROL_DOWN)
+        self.space_pressed = bool(controls & constants.CONTROL_SPACE)
+
+    def controls_mask(self):
+        '''returns the *_pressed flags as a mask of constants.CONTROL_* bits'''
+        return (self.right_pressed * constants.CONTROL_RIGHT | self.left_pressed * constants.CONTROL_LEFT |
+                self.up_pressed * constants.CONTROL_UP | self.down_pressed * constants.CONTROL_DOWN |
+                self.space_pressed * constants.CONTROL_SPACE)
+
+    def save_recording(self):
+        os.makedirs(self.recordFolder, exist_ok=True)
+        filename = 'run_{}_{}.trace'.format(time.strftime('%Y%m%d-%H%M%S'), self.random.seed)
+        self.inputTrace.save(os.path.join(self.recordFolder, filename))
+
+    @traced('update')
     def update(self):
         self.allSprites.update() #runs .update() on all objects in allSprites
+        self.handle_collisions()
 
         if len(self.rows) <= 16:
             self.load_new_section()
@@ -106,16 +227,169 @@ class Game:
         if self.bombs > self.maxbombs:
             self.bombs = self.maxbombs
             
+    @traced('handle_collisions')
+    def handle_collisions(self):
+        '''The frame's one collision pass, once everything has moved. Brings the moving
+        entities up to date in self.entities, then hands everything near the player and
+        each thrown bomb to their handler for its type, which checks the exact hitboxes'''
+        self.entities.update(self.bomb_upgrades)
+
+        for actor in [self.player] + list(self.thrownBombs):
+            if not actor.alive():
+                continue
+            for entity in self.entities.query(actor.rect) + self.butterflies.query(actor.rect):
+                handler = actor.collisionHandlers.get(entity.type)
+                if handler is not None and entity.alive():
+                    handler(actor, entity)
+                if not actor.alive():
+                    break
+
+    @traced('draw')
     def draw(self):
-        self.truescreen.fill(constants.LIGHT_BLUE)
-        self.allSprites.draw(self.truescreen)
-        self.draw_bomb_icons()
-        self.screen.blit(pg.transform.scale(self.truescreen, (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT)), (0, 0))
-        self.draw_score()
-        pg.display.flip()
+        '''Redraws only what changed since the last frame when the camera and the
+        terrain stood still, everything otherwise'''
+        view = (self.scrollLength, self.terrain.first, self.terrain.nextToTexture, self.overlay.visible)
+        spriteRects = self.sprite_screen_rects()
+        hud = (self.bombs, self.maxbombs)
+        if (constants.RENDERING == 'dirty' and constants.SCALING == 'fast'
+                and view == self.lastView and not self.overlay.visible):
+            dirty = spriteRects + self.lastSpriteRects
+            if hud != self.lastHud:
+                dirty += [self.bomb_icons_rect(*hud), self.bomb_icons_rect(*self.lastHud)]
+            self.draw_dirty(dirty)
+        else:
+            self.truescreen.fill(constants.LIGHT_BLUE)
+            self.draw_sprites()
+            self.draw_bomb_icons()
+            self.scale_to_screen()
+            self.draw_score()
+            if self.overlay.visible:
+                self.overlay.draw(self.screen, self, 10, 70)
+            pg.display.flip()
+        self.lastView = view
+        self.lastSpriteRects = spriteRects
+        self.lastHud = hud
+
+    def draw_dirty(self, rects):
+        '''Redraws the truescreen regions in rects and updates only those parts of the window'''
+        dirty = self.merge_rects(rects)
+        if not dirty:
+            return
+        #The score is blended onto the window, so it is drawn again whole or not at all
+        size = self.pixelSize
+        scoreRect = self.score_rect()
+        scoreArea = Rect(scoreRect.x // size, scoreRect.y // size,
+                         -(-scoreRect.right // size) - scoreRect.x // size,
+                         -(-scoreRect.bottom // size) - scoreRect.y // size)
+        if scoreArea.collidelist(dirty) != -1:
+            dirty = self.merge_rects(dirty + [scoreArea])
+
+        windowRects = []
+        for rect in dirty:
+            self.truescreen.set_clip(rect)
+            self.truescreen.fill(constants.LIGHT_BLUE, rect)
+            self.draw_sprites()
+            self.draw_bomb_icons()
+            windowRect = Rect(rect.x * size, rect.y * size, rect.width * size, rect.height * size)
+            pg.transform.scale(self.truescreen.subsurface(rect), windowRect.size, self.screen.subsurface(windowRect))
+            windowRects.append(windowRect)
+        self.truescreen.set_clip(None)
+        if scoreArea.collidelist(dirty) != -1:
+            self.draw_score()
+        pg.display.update(windowRects)
+
+    def merge_rects(self, rects):
+        '''returns rects clipped to the truescreen, with overlapping ones merged'''
+        bounds = self.truescreen.get_rect()
+        merged = []
+        for rect in rects:
+            rect = rect.clip(bounds)
+            if not rect.width or not rect.height:
+                continue
+            overlap = rect.collidelist(merged)
+            while overlap != -1:
+                rect.union_ip(merged.pop(overlap))
+                overlap = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def sprite_screen_rects(self):
+        '''returns where on the truescreen each sprite's image lands, the terrain aside,
+        for the sprites draw_sprites draws'''
+        camera = self.scrollLength
+        top, bottom = self.drawn_band()
+        return [Rect((sprite.rect.x, sprite.rect.y - camera), sprite.image.get_size())
+                for sprite in self.allSprites if sprite is not self.terrain and sprite is not self.butterflies
+                and sprite.rect.bottom > top and sprite.rect.top < bottom
+                ] + self.butterflies.screen_rects(self.truescreen, camera)
+
+    def drawn_band(self):
+        '''returns the world y coordinates between which sprites are drawn: the
+        truescreen's, widened by constants.CULL_MARGIN'''
+        return (self.scrollLength - constants.CULL_MARGIN,
+                self.scrollLength + self.truescreen.get_height() + constants.CULL_MARGIN)
+
+    def scale_to_screen(self):
+        '''Upscales truescreen straight into the window, without a temporary surface'''
+        if constants.SCALING == 'smooth':
+            pg.transform.smoothscale(self.truescreen, (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT), self.screen)
+        else:
+            pg.transform.scale(self.truescreen, (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT), self.screen)
+
+    def draw_sprites(self, sprites=None):
+        '''Sprites live in world coordinates, the camera sits scrollLength pixels down
+        @param sprites: a slice of allSprites.sprites() to draw instead of all of them'''
+        camera = self.scrollLength
+        top, bottom = self.drawn_band()
+        if sprites is None:
+            sprites = self.allSprites.sprites()
+        #The terrain and the butterflies draw themselves, the rest are blitted in runs
+        #between them, leaving out those outside the drawn band
+        run = []
+        for sprite in sprites:
+            if sprite is self.terrain or sprite is self.butterflies:
+                self.truescreen.blits(run, False)
+                run = []
+                sprite.draw(self.truescreen, camera)
+            elif sprite.rect.bottom > top and sprite.rect.top < bottom:
+                run.append((sprite.image, (sprite.rect.x, sprite.rect.y - camera)))
+        self.truescreen.blits(run, False)
+
+    def unload_rows_above_screen(self):
+        '''Unloads the platforms and spikes of the rows that have scrolled off the top'''
+        while len(self.terrain) and self.terrain.top_row_bottom() < self.scrollLength:
+            self.unload_top_row()
+
+    def unload_top_row(self):
+        '''Unloads the topmost row, returning its platforms and spikes to their pools.
+        Spikes stay attached to their row when they are blown up, so this is the one
+        place they are released'''
+        for sprite in self.terrain.popleft():
+            if sprite.type == "platform":
+                self.platforms.remove(sprite)
+                self.tilegrid.remove(sprite)
+                self.pools['platforms'].release(sprite)
+            elif sprite.type == "spike":
+                self.spikes.remove(sprite)
+                sprite.kill()
+                self.pools['spikes'].release(sprite)
+            else:
+                sprite.kill()
+
+    def entity_counts(self):
+        '''returns the number of live entities of each type'''
+        return {'platforms': len(self.platforms), 'spikes': len(self.spikes),
+                'butterflies': len(self.butterflies), 'bombs': len(self.thrownBombs),
+                'bomb upgrades': len(self.bomb_upgrades)}
+
+    def pool_counts(self):
+        '''returns the hits and misses of each pool since the game started'''
+        return {name: {'hits': pool.hits, 'misses': pool.misses} for name, pool in self.pools.items()}
 
     def gameover(self):
         
+        if self.recordFolder is not None:
+            self.save_recording()
         pg.mixer.music.load(os.path.join('resources','sounds','Come and Find Me (Eric Skiff).wav'))
         pg.mixer.music.play(-1)
         self.sound_gameover.play()
@@ -124,19 +398,28 @@ class Game:
         fadeout = self.truescreen.copy()
         fadeout.fill(constants.RED)
         messageSurface, messageRect, OHsurface, OHrect = self.render_gameover_message()
+        frozenScene, spritesOverScene = self.freeze_scene()
+        shown = None
         while not restart:
             self.clock.tick(60)
             dead_time = time.time() - t0
             restart = self.gameover_events(t0, restart, dead_time)
-            self.truescreen.fill(constants.LIGHT_BLUE)
-            self.allSprites.draw(self.truescreen)
-            self.draw_bomb_icons()
             fadeAlpha = int(dead_time*20)
             if fadeAlpha > 100:
                 fadeAlpha = 100
+            #Only the dead fox, the fade and the text change, redraw when one of them did
+            foxPosition = self.deadFox.rect.topleft if self.deadFox.alive() else None
+            frame = (foxPosition, fadeAlpha, dead_time > 1, int(dead_time*2)%2 == 0)
+            if frame == shown:
+                continue
+            shown = frame
+
+            self.truescreen.blit(frozenScene, (0, 0))
+            self.draw_sprites(spritesOverScene)
+            self.draw_bomb_icons()
             fadeout.set_alpha(fadeAlpha)
             self.truescreen.blit(fadeout, (0, 0))
-            self.screen.blit(pg.transform.scale(self.truescreen, (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT)), (0, 0))
+            self.scale_to_screen()
             self.draw_score()
             if dead_time > 1:
                 if int(dead_time*2)%2 == 0:
@@ -147,6 +430,15 @@ class Game:
         for sprite in self.allSprites:
             sprite.kill()
 
+    def freeze_scene(self):
+        '''Draws everything layered below the dead fox once, as nothing else moves after death.
+        returns that surface and the sprites from the fox up, to draw over it'''
+        sprites = self.allSprites.sprites()
+        foxIndex = sprites.index(self.deadFox) if self.deadFox.alive() else len(sprites)
+        self.truescreen.fill(constants.LIGHT_BLUE)
+        self.draw_sprites(sprites[:foxIndex])
+        return self.truescreen.copy(), sprites[foxIndex:]
+
     def render_gameover_message(self):
 
         GOmessage = "Press any key to restart"
@@ -206,36 +498,43 @@ class Game:
         return (new_highscore, str(highscore))
 
     def draw_score(self):
-        scoremessage = "Score: {}".format(self.score)
-        scoreSurface = self.font.render(scoremessage, True, constants.GREEN)
-        scoreRect = scoreSurface.get_rect()
-        scoreRect.x = constants.WINDOW_WIDTH - 160
-        scoreRect.y = 10
-        self.screen.blit(scoreSurface, scoreRect)
+        '''The score text is only rendered again when the score changes'''
+        if self.score != self.scoreShown:
+            scoremessage = "Score: {}".format(self.score)
+            self.scoreSurface = self.font.render(scoremessage, True, constants.GREEN)
+            self.scoreShown = self.score
+        self.screen.blit(self.scoreSurface, self.score_rect())
+
+    def score_rect(self):
+        return Rect((constants.WINDOW_WIDTH - 160, 10), self.scoreSurface.get_size())
 
     def load_icons(self):
-        bomb_icon_filename = os.path.join('resources','images','bomb_icon.png')
         book = {}
-        book['bomb_icon'] = pg.image.load(bomb_icon_filename).convert()
-        book['bomb_icon'].set_colorkey(constants.WHITE)
-        pale_bomb_icon_filename = os.path.join('resources','images','pale_bomb_icon.png')
-        book['pale_bomb_icon'] = pg.image.load(pale_bomb_icon_filename).convert()
-        book['pale_bomb_icon'].set_colorkey(constants.WHITE)
-        bomb_upgrade_filename = os.path.join('resources','images','bomb_upgrade.png')
-        book['bomb_upgrade'] = pg.image.load(bomb_upgrade_filename).convert()
-        book['bomb_upgrade'].set_colorkey(constants.WHITE)
+        for name in ('bomb_icon', 'pale_bomb_icon', 'bomb_upgrade'):
+            book[name] = self.assets.images[name]
+
+        #The recharging bomb, revealed one pixel column at a time
+        icon = book['bomb_icon']
+        book['partial_bomb_icons'] = []
+        for width in range(icon.get_width() + 1):
+            partial_bomb = icon.copy()
+            partial_bomb.fill(constants.WHITE)
+            partial_bomb.blit(icon, (0, 0), area=Rect(0, 0, width, icon.get_height()))
+            book['partial_bomb_icons'].append(partial_bomb)
         return book
 
+    def bomb_icons_rect(self, bombs, maxbombs):
+        '''returns the truescreen area draw_bomb_icons covers with these bomb counts'''
+        icon = self.guibook['bomb_icon']
+        return Rect(5, 8, 16*max(maxbombs, int(bombs)+1), icon.get_height())
+
     def draw_bomb_icons(self):
         if self.maxbombs > self.bombs:
             for ghost_bomb in range(self.maxbombs):
                 self.truescreen.blit(self.guibook['pale_bomb_icon'], (5+16*ghost_bomb, 8))
             partial_bomb_amount = self.bombs-int(self.bombs)
             partial_bomb_width = int(partial_bomb_amount * self.guibook['bomb_icon'].get_width())
-            partial_bomb_height = self.guibook['bomb_icon'].get_height()
-            partial_bomb = self.guibook['bomb_icon'].copy()
-            partial_bomb.fill(constants.WHITE)
-            partial_bomb.blit(self.guibook['bomb_icon'], (0, 0), area=Rect(0, 0, partial_bomb_width, partial_bomb_height))
+            partial_bomb = self.guibook['partial_bomb_icons'][max(0, partial_bomb_width)] #bombs can dip below 0
             self.truescreen.blit(partial_bomb, (5+16*int(self.bombs), 8))
             
         for bomb in range(int(self.bombs)):
@@ -243,54 +542,66 @@ class Game:
 
 
     def load_section_into_rows(self, sectionName):
-        sectionPath = os.path.join('resources', 'images', 'sections', 'section_{}.png'.format(sectionName))
-        sectionSurface = pg.image.load(sectionPath).convert_alpha()
-        height = sectionSurface.get_height()
-        
-        for y in range(height):
-            self.rows.append([])
-            for x in range(sectionSurface.get_width()):
-                if sectionSurface.get_at((x, y))[:3] == (0, 0, 0):
-                    self.rows[-1].append(x)
-
-        return height
+        section = self.sectionCache.get(sectionName)
+        self.rows.extend(section)
+        return len(section)
 
+    @traced('spawn_row_of_platforms')
     def spawn_row_of_platforms(self, row):
-        if self.platforms:
-            yPos = self.platforms[-1].rect.bottom
-        else:
-            yPos = 0
-        
+        yPos = (self.terrain.first + len(self.terrain)) * constants.TILE_SIZE
+
+        platformsInRow = []
         for xPosition in self.rows[row]:
-            platform = Platform(20*xPosition, yPos, 20, 20)
-            self.platforms.append(platform)
-            self.allSprites.add(platform)
+            platform = self.pools['platforms'].acquire(20*xPosition, yPos, 20, 20)
+            self.platforms.add(platform)
+            self.tilegrid.add(platform)
+            platformsInRow.append(platform)
+        self.terrain.append(platformsInRow)
 
-        if yPos > 300:
-            if randint(1,1000) > 900 - self.luck:
-                butt = Butterfly(self, randint(0,200), yPos)
-                self.allSprites.add(butt, layer=2)
-                self.butterflies.append(butt)
+        if yPos - self.scrollLength > 300:
+            if self.random.butterflies.randint(1,1000) > 900 - self.luck:
+                self.butterflies.spawn(self.random.butterflies.randint(0,200), yPos)
 
     def load_starting_section(self):
         self.load_section_into_rows("start")
 
+    def start_planner(self):
+        '''(Re)starts planning sections from the end of the loaded terrain'''
+        if self.planner is not None:
+            self.planner.stop()
+        nextRow = self.terrain.first + len(self.terrain)
+        self.planner = SectionPlanner(self.sectionCache.numbered_rows(), self.random, nextRow,
+                                      (self.terrain.mask(nextRow-2), self.terrain.mask(nextRow-1)))
+
+    @traced('load_new_section')
     def load_new_section(self):
-        
-        oldrowsLoaded = len(self.rows)
-        sectionsToLoad = len(os.listdir(os.path.join('resources', 'images', 'sections'))) - 1
-        sectionNumber = randint(1,sectionsToLoad)
-        height = self.load_section_into_rows(str(sectionNumber))
-        rowsLoaded = len(self.rows)
-        for i in range(height):
-            rowToSpawn = rowsLoaded-height+i
+        '''Spawns the next section planned by self.planner, and passes it the sections
+        that changed on disk meanwhile, decoding them here rather than on its thread'''
+        self.planner.set_sections(self.sectionCache.numbered_rows())
+        firstRow, rows, tiles = self.planner.take()
+        if firstRow != self.terrain.first + len(self.terrain) or self.terrain.nextToTexture != firstRow - 1:
+            #Rows were spawned or textured behind the planner's back, so its plans don't fit
+            self.start_planner()
+            firstRow, rows, tiles = self.planner.take()
+
+        self.rows.extend(rows)
+        for rowToSpawn in range(len(self.rows) - len(rows), len(self.rows)):
             self.spawn_row_of_platforms(rowToSpawn)
 
-        for _ in range(rowsLoaded - oldrowsLoaded):
-            self.texture_next_row_of_tiles()
+        for rowTiles in tiles:
+            row = self.terrain.nextToTexture
+            for platform, (neighborkey, spikes) in zip(self.terrain.row(row), rowTiles):
+                for x, y, direction, roll in spikes:
+                    self.maybe_spawn_spike(x, y, direction, roll)
+                platform.neighborkey = neighborkey
+                platform.image = self.autotiles[neighborkey]
+                platform.has_texture = True
+            self.terrain.bake(row)
+            self.terrain.nextToTexture += 1
+        self.sectionsLoaded += 1
 
     def initialize_tilebook(self):
-        soil_tiles = Spritesheet('soil-tiles.png', constants.BLACK)
+        soil_tiles = self.assets.sheets['soil']
         tilebook = {}
         tilebook['soil'] = {}
         tilebook['soil']['alone'] = soil_tiles.get_image(0, 0, 20, 20)
@@ -312,133 +623,88 @@ class Game:
         tilebook['soil']['corners'] = soil_tiles.get_image(80, 0, 20, 20)
         
         return tilebook
+
+    def initialize_autotiles(self):
+        '''returns a list of precomposed soil tiles, indexed by neighbour mask.
+        Platforms with the same neighbours share the same Surface, so don't draw on them'''
+        autotiles = []
+        corners = self.tilebook['soil']['corners']
+        for neighborkey in range(256):
+            upleft, up, upright, left, right, downleft, down, downright = [neighborkey >> bit & 1 for bit in range(8)]
+            texture_ID = ''
+            if not (up or right or down or left):
+                texture_ID = 'alone'
+            for direction, present in (('N', up), ('E', right), ('S', down), ('W', left)):
+                if present:
+                    texture_ID += direction
+            img = self.tilebook['soil'][texture_ID].copy()
+            if up and left and not upleft:
+                img.blit(corners, (0, 0), area=pg.Rect(0, 0, 10, 10))
+            if up and right and not upright:
+                img.blit(corners, (10, 0), area=pg.Rect(10, 0, 10, 10))
+            if down and left and not downleft:
+                img.blit(corners, (0, 10), area=pg.Rect(0, 10, 10, 10))
+            if down and right and not downright:
+                img.blit(corners, (10, 10), area=pg.Rect(10, 10, 10, 10))
+            autotiles.append(img)
+        return autotiles
     
+    @traced('texture_next_row_of_tiles')
     def texture_next_row_of_tiles(self):
-        
-        for i, plat in enumerate(self.platforms):
-            if not plat.has_texture:
-                target_elevation = plat.rect.y
-                same_level = []
-                next_level = []
-                previous_level = []
-                
-                for j in range(i, len(self.platforms)):
-                    
-                    #Locate all platforms on that row
-                    if self.platforms[j].rect.y == target_elevation:
-                        same_level.append(self.platforms[j])
-                    #Locate the row below
-                    elif self.platforms[j].rect.y == target_elevation + plat.rect.height:
-                        next_level.append(self.platforms[j])
-                    else:
-                        break
-
-                if i == 0:
-                    previous_level = False
-                else:
-                    #Locate the row above
-                    for k in range(i-1, 0, -1):
-                        if self.platforms[k].rect.y == target_elevation - plat.rect.height:
-                            previous_level.append(self.platforms[k])
-                        else:
-                            break
-
-                if not next_level:
-                    print("Error: Tried to texture last existing row")
-                break
-        
-        for platform in same_level:
-            self.texture_tile(platform, previous_level, same_level, next_level)
+        row = self.terrain.nextToTexture
+        if self.terrain.mask(row+1) is None:
+            print("Error: Tried to texture last existing row")
+            return
+
+        upper = self.terrain.padded_mask(row-1)
+        same = self.terrain.padded_mask(row)
+        lower = self.terrain.padded_mask(row+1)
+        for platform in self.terrain.row(row):
+            self.texture_tile(platform, upper, same, lower)
+        self.terrain.bake(row)
+        self.terrain.nextToTexture += 1
 
     def texture_tile(self, platform, upper, same, lower):
-        
-        up = False
-        upleft = False
-        upright = False
-        right = False
-        left = False
-        downleft = False
-        down = False
-        downright = False
-
-        if platform.rect.x == 0:
-            upleft = True
-            left = True
-            downleft = True
-        elif platform.rect.x == 180:
-            upright = True
-            right = True
-            downright = True
-        
-        if not upper:
-            up = True
-            upleft = True
-            upright = True
-        else:
-            for plat in upper:
-                if plat.rect.x == platform.rect.x:
-                    up = True
-                elif plat.rect.x == platform.rect.x-20:
-                    upleft = True
-                elif plat.rect.x == platform.rect.x+20:
-                    upright = True
-
-        for plat in same:
-            if plat.rect.x == platform.rect.x - platform.rect.width or platform.rect.left == 0:
-                left = True
-            if plat.rect.x == platform.rect.x + platform.rect.width or platform.rect.left == 180:
-                right = True
-
-        for plat in lower:
-            if plat.rect.x == platform.rect.x:
-                down = True
-            elif plat.rect.x == platform.rect.x-20:
-                downleft = True
-            elif plat.rect.x == platform.rect.x+20:
-                downright = True
-
-        texture_ID = ''
-        if not (up or right or down or left):
-            texture_ID = 'alone'
-        if up:
-            texture_ID += 'N'
-        else:
-            self.maybe_spawn_spike(platform.rect.left+2, platform.rect.top-11, "N")
-        if right:
-            texture_ID += 'E'
-        else:
-            self.maybe_spawn_spike(platform.rect.right-4, platform.rect.top+2, "E")
-        if down:
-            texture_ID += 'S'
-        else:
-            self.maybe_spawn_spike(platform.rect.left+2, platform.rect.bottom-4, "S")
-        if left:
-            texture_ID += 'W'
-        else:
-            self.maybe_spawn_spike(platform.rect.left-11, platform.rect.top+2, "W")
-            
-        img = self.tilebook['soil'][texture_ID].copy()
-        if up and left and not upleft:
-            img.blit(self.tilebook['soil']['corners'], (0, 0), area=pg.Rect(0, 0, 10, 10))
-        if up and right and not upright:
-            img.blit(self.tilebook['soil']['corners'], (10, 0), area=pg.Rect(10, 0, 10, 10))
-        if down and left and not downleft:
-            img.blit(self.tilebook['soil']['corners'], (0, 10), area=pg.Rect(0, 10, 10, 10))
-        if down and right and not downright:
-            img.blit(self.tilebook['soil']['corners'], (10, 10), area=pg.Rect(10, 10, 10, 10))
-        platform.image = img
+        '''upper, same and lower are padded row masks from TerrainRows.padded_mask'''
+
+        column = platform.rect.x // constants.TILE_SIZE
+        platform.neighborkey = TerrainRows.neighbor_key(column, upper, same, lower)
+        for direction, bit, dx, dy in Spike.sides:
+            if not platform.neighborkey >> bit & 1:
+                self.maybe_spawn_spike(platform.rect.left+dx, platform.rect.top+dy, direction)
+        platform.image = self.autotiles[platform.neighborkey]
         platform.has_texture = True
-        platform.neighborkey = [upleft, up, upright, left, right, downleft, down, downright]
 
-    def maybe_spawn_spike(self, x, y, direction):
-        if randint(1,1000) > 990 - self.scrollLength/30 + self.luck:
-            spike = Spike(self, x, y, direction)
+    def maybe_spawn_spike(self, x, y, direction, roll=None):
+        '''@param roll: the spikes stream's roll for this spike, if it was drawn ahead of time'''
+        if roll is None:
+            roll = self.random.spikes.randint(1,1000)
+        if roll > 990 - self.scrollLength/30 + self.luck:
+            spike = self.pools['spikes'].acquire(self, x, y, direction)
             self.allSprites.add(spike, layer=-1)
-            self.spikes.append(spike)
+            self.spikes.add(spike)
+            self.terrain.attach(spike)
 
 def main():
+    parser = argparse.ArgumentParser(description="Catfall")
+    parser.add_argument('--record', metavar='FOLDER', help="save the inputs of every run into FOLDER")
+    parser.add_argument('--replay', metavar='TRACE', help="replay a recorded run, then play on")
+    parser.add_argument('--fast-forward', type=int, default=0, metavar='FRAME',
+                        help="play the replay uncapped and without drawing up to FRAME")
+    parser.add_argument('--chrome-trace', metavar='FILE', help="write a Chrome trace of the game's phases to FILE")
+    args = parser.parse_args()
+
+    if args.chrome_trace:
+        tracer.start(args.chrome_trace)
+        atexit.register(tracer.stop)
+
     game = Game()
+    game.recordFolder = args.record
+    if args.replay:
+        trace = InputTrace.load(args.replay)
+        game.start(trace.seed, iter(trace.controls), args.fast_forward)
     while True:
         game.start()
 
-main()
+if __name__ == '__main__':
+    main()
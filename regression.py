@@ -0,0 +1,91 @@
+'''Frame time regression gate. Plays the recorded sessions through Game.frame,
+drawing every frame but without a frame cap, and compares the percentiles of
+the time spent in events, update and draw against a stored baseline.
+
+Exits with status 1 if any of them got slower than the baseline allows.
+
+Example: python regression.py                    compare against sessions/baseline.json
+         python regression.py --update-baseline  store this machine's timings instead
+'''
+import argparse, glob, json, os, sys
+from main import Game
+from classes import InputTrace
+
+PHASES = ('events', 'update', 'draw')
+PERCENTILES = (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+
+def percentile(sortedValues, percent):
+    index = min(len(sortedValues) - 1, int(len(sortedValues) * percent / 100))
+    return sortedValues[index]
+
+def play_sessions(game, paths):
+    '''returns the milliseconds spent in each phase, for every frame of every session'''
+    times = {phase: [] for phase in PHASES}
+    for path in paths:
+        trace = InputTrace.load(path)
+        game.reset(trace.seed)
+        game.alive = True
+        for controls in trace.controls:
+            game.frame(controls)
+            for phase, seconds in zip(PHASES, game.phaseTimes):
+                times[phase].append(seconds * 1000)
+            if not game.alive:
+                break
+    return times
+
+def summarize(times):
+    summary = {}
+    for phase in PHASES:
+        values = sorted(times[phase])
+        summary[phase] = {name: round(percentile(values, percent), 4) for name, percent in PERCENTILES}
+    return summary
+
+def best_of(summaries):
+    '''returns the lowest value of every statistic over several summaries, to filter out noise'''
+    return {phase: {name: min(summary[phase][name] for summary in summaries) for name, _ in PERCENTILES}
+            for phase in PHASES}
+
+def regressions(summary, baseline, tolerance, slack):
+    '''returns a message for every statistic that is over baseline * tolerance + slack'''
+    messages = []
+    for phase in PHASES:
+        for name, _ in PERCENTILES:
+            allowed = baseline[phase][name] * tolerance + slack
+            if summary[phase][name] > allowed:
+                messages.append("{} {}: {:.3f} ms, allowed {:.3f} ms (baseline {:.3f} ms)".format(
+                    phase, name, summary[phase][name], allowed, baseline[phase][name]))
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', nargs='+', metavar='TRACE',
+                        default=sorted(glob.glob(os.path.join('sessions', '*.trace'))))
+    parser.add_argument('--baseline', default=os.path.join('sessions', 'baseline.json'))
+    parser.add_argument('--repeats', type=int, default=3, help='play the sessions this many times, keep the best')
+    parser.add_argument('--tolerance', type=float,
+                        help="allowed slowdown factor, defaults to the baseline's own or 1.25")
+    parser.add_argument('--slack', type=float, default=0.1, help='milliseconds always allowed on top')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args()
+
+    game = Game(headless=True)
+    summary = best_of([summarize(play_sessions(game, args.sessions)) for _ in range(args.repeats)])
+    print(json.dumps(summary, indent=2))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'tolerance': args.tolerance or 1.25, 'phases': summary}, f, indent=2)
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    tolerance = args.tolerance or baseline.get('tolerance', 1.25)
+    messages = regressions(summary, baseline['phases'], tolerance, args.slack)
+    for message in messages:
+        print("Regression: " + message)
+    if messages:
+        sys.exit(1)
+    print("No regressions")
+
+if __name__ == '__main__':
+    main()